@@ -1,14 +1,57 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-import psycopg2
-from datetime import datetime
-import traceback
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Response, make_response, render_template, request, redirect, url_for, session, flash, g, jsonify, stream_template, stream_with_context
+from datetime import datetime, timezone
+from functools import wraps
+import hashlib
+import hmac
+import base64
+import csv
+import io
+import itertools
+import json
+import logging
+import math
+import re
 import os
+import click
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from assets import setup_assets
+from cache import StaleWhileRevalidateCache, TTLCache
+import metrics
+import migrate
+import repository
+from db import ConnectionPool, ChangeListener, query_observers
+from logging_config import setup_logging
+from passwords import HASH_PREFIXES, Overloaded, PasswordHasher
+from ratelimit import RateLimiter
+import sales_stats
+from tracing import QueryTracer
 
 load_dotenv()
 app = Flask(__name__)
 
+# Число доверенных прокси (балансировщиков) перед приложением: адрес клиента
+# и схема берутся из X-Forwarded-For / X-Forwarded-Proto, которые они добавили.
+# Без этого за балансировщиком у всех клиентов один remote_addr
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+setup_logging(app)
+metrics.setup_metrics(app)
+setup_assets(app)
+query_observers.append(metrics.observe_query)
+
+# Трассировка SQL: медленные запросы в лог, EXPLAIN - только вне production
+query_tracer = QueryTracer(
+    slow_ms=float(os.getenv('SQL_SLOW_MS', 200)),
+    explain=os.getenv('SQL_EXPLAIN', '0') == '1' and os.getenv('APP_ENV', 'production') != 'production',
+    prepared=repository.statement_sql(),
+)
+query_observers.append(query_tracer)
+logger = logging.getLogger(__name__)
+
 # Берем секретный ключ из переменных окружения
 app.secret_key = os.getenv('SECRET_KEY')
 
@@ -20,14 +63,234 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD')
 }
 
+# Пул соединений: размер задается на один воркер gunicorn
+db_pool = ConnectionPool(
+    DB_CONFIG,
+    maxconn=int(os.getenv('DB_POOL_MAX', 10)),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+    check_after=float(os.getenv('DB_POOL_CHECK_AFTER', 30)),
+)
+
+
+def check_schema():
+    """Проверка индексов из migrations/ перед запуском приложения.
+
+    Без них горячие запросы уходят в последовательное сканирование, поэтому
+    при нехватке индексов выбрасывается migrate.SchemaError. Проверка не
+    выполняется при импорте модуля: ее запускают при развертывании перед
+    gunicorn (flask --app app check-schema) или app.py при запуске напрямую.
+    """
+    schema_conn = db_pool.getconn()
+    try:
+        migrate.check_schema(schema_conn)
+    finally:
+        db_pool.putconn(schema_conn)
+
+
+@app.cli.command('check-schema')
+def check_schema_command():
+    """Проверить индексы горячих запросов"""
+    try:
+        check_schema()
+    except migrate.SchemaError as e:
+        raise click.ClickException(str(e))
+    click.echo('Все требуемые индексы на месте')
+
+
 def get_db_connection():
-    """Функция для подключения к базе данных"""
+    """Соединение с базой данных, привязанное к текущему запросу"""
+    if 'db_conn' not in g:
+        try:
+            g.db_conn = db_pool.getconn()
+        except Exception as e:
+            logger.error("Ошибка подключения к БД: %s", e)
+            return None
+    return g.db_conn
+
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """Возвращаем соединение запроса в пул"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        db_pool.putconn(conn)
+
+
+# Кэш каталога: категории, первые страницы списков товаров и карточки товаров
+catalog_cache = TTLCache(
+    maxsize=int(os.getenv('CATALOG_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('CATALOG_CACHE_TTL', 300)),
+)
+
+# Страницы каталога по курсору: ключей столько, сколько курсоров пришло от
+# клиентов, поэтому у них свой небольшой кэш, и глубокое листание не вытесняет
+# из catalog_cache карточки товаров и первые страницы
+listing_cache = TTLCache(
+    maxsize=int(os.getenv('LISTING_CACHE_SIZE', 256)),
+    ttl=float(os.getenv('CATALOG_CACHE_TTL', 300)),
+)
+
+# Результаты поиска по нормализованному запросу - тоже отдельно от catalog_cache:
+# запросы задают посетители, и редкие из них не должны вытеснять каталог
+search_cache = TTLCache(
+    maxsize=int(os.getenv('SEARCH_CACHE_SIZE', 256)),
+    ttl=float(os.getenv('CATALOG_CACHE_TTL', 300)),
+)
+
+# Кэш готовых страниц для анонимных посетителей (главная страница)
+page_cache = TTLCache(maxsize=16, ttl=float(os.getenv('HOME_PAGE_CACHE_TTL', 30)))
+
+# Кэш профилей пользователей по id: шапка страниц и адрес доставки по умолчанию
+user_cache = TTLCache(
+    maxsize=int(os.getenv('USER_CACHE_SIZE', 4096)),
+    ttl=float(os.getenv('USER_CACHE_TTL', 60)),
+)
+
+# Кэш результатов SQL-отчетов (/execute_query/<id>): ключ - (id отчета, параметры),
+# срок жизни задается для каждого отчета в REPORT_CACHE_POLICY. Записи бывают
+# от одной строки до REPORT_CACHE_MAX_ROWS, поэтому память ограничивается
+# еще и суммарным числом строк
+report_cache = StaleWhileRevalidateCache(
+    maxsize=int(os.getenv('REPORT_CACHE_SIZE', 256)),
+    stale_ttl=float(os.getenv('REPORT_CACHE_STALE_TTL', 300)),
+    maxweight=int(os.getenv('REPORT_CACHE_TOTAL_ROWS', 20000)),
+    weigh=lambda report: len(report[1]),
+)
+# Большие результаты не кэшируются, а отдаются потоком
+REPORT_CACHE_MAX_ROWS = int(os.getenv('REPORT_CACHE_MAX_ROWS', 1000))
+
+# Уведомления об изменениях в БД (триггеры из миграций catalog_notify,
+# review_notify, report_notify и user_notify)
+change_listener = ChangeListener(DB_CONFIG)
+
+
+def invalidate_catalog(payload=None):
+    """Сбрасываем кэш каталога после записи в product или category"""
+    catalog_cache.invalidate()
+    listing_cache.invalidate()
+    search_cache.invalidate()
+    page_cache.invalidate('index')
+    invalidate_reports(payload)
+
+
+def invalidate_home_page(payload=None):
+    """Сбрасываем закэшированную главную страницу после изменения одобренных отзывов"""
+    page_cache.invalidate('index')
+    invalidate_reports('review' if payload else None)
+
+
+def invalidate_reports(table=None):
+    """Сбрасываем отчеты, построенные по таблице table (без аргумента - все)"""
+    if table is None:
+        report_cache.invalidate()
+        return
+    query_ids = {query_id for query_id, (ttl, tables) in REPORT_CACHE_POLICY.items() if table in tables}
+    report_cache.invalidate_where(lambda key: key[0] in query_ids)
+
+
+change_listener.subscribe('catalog_changed', invalidate_catalog)
+change_listener.subscribe('reviews_changed', invalidate_home_page)
+
+
+def invalidate_user(user_id=None):
+    """Сбрасываем кэшированный профиль пользователя (без аргумента - все профили)"""
+    if user_id is None:
+        user_cache.invalidate()
+    else:
+        user_cache.invalidate(int(user_id))
+
+
+change_listener.subscribe('table_changed', invalidate_reports)
+change_listener.subscribe('user_changed', invalidate_user)
+
+# Сверка агрегатов продаж (миграция sales_stats), 0 - отключить; свертка дельт
+# общей статистики (миграция sales_totals_delta) выполняется всегда
+sales_stats_refresher = sales_stats.SalesStatsRefresher(
+    db_pool,
+    interval=float(os.getenv('SALES_STATS_REFRESH', 600)),
+    fold_interval=float(os.getenv('SALES_TOTALS_FOLD', 60)),
+)
+
+
+@app.before_request
+def start_background_threads():
+    """Поток LISTEN и сверка агрегатов запускаются в каждом воркере при первом запросе"""
+    if os.getenv('CATALOG_LISTEN', '1') == '1':
+        change_listener.start()
+    sales_stats_refresher.start()
+
+
+def fetch_catalog(key, sql, params=(), one=False, cache=catalog_cache):
+    """Читаем данные каталога через кэш, соединение берется только при промахе"""
+    def load():
+        cur = get_db_connection().cursor()
+        cur.execute(sql, params)
+        result = cur.fetchone() if one else cur.fetchall()
+        cur.close()
+        return result
+
+    return cache.get_or_load(key, load)
+
+
+def catalog_validators():
+    """ETag и Last-Modified страницы каталога или None, если версия каталога недоступна.
+
+    Версия берется из catalog_version (миграция catalog_notify) и кэшируется вместе
+    с каталогом. В ETag входят пользователь, счетчик корзины из шапки страницы
+    и хэш манифеста статики, а Last-Modified не раньше сборки статики: иначе
+    после пересборки браузер получал бы 304 на страницу со старыми ссылками.
+    """
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        print(f" Ошибка подключения к БД: {e}")
+        version = fetch_catalog(('version',), 'SELECT version, updated_at FROM catalog_version;', one=True)
+    except Exception:
+        logger.exception("Не удалось получить версию каталога")
         return None
+    if not version:
+        return None
+
+    page_state = f"{request.full_path}|{session.get('user_id')}|{session.get('cart_items_count', 0)}"
+    etag = f"c{version[0]}-{app.config['ASSET_BUILD_ID']}-{hashlib.sha1(page_state.encode()).hexdigest()[:16]}"
+    last_modified = version[1].astimezone(timezone.utc).replace(microsecond=0)
+    built_at = app.config['ASSET_BUILT_AT']
+    if built_at is not None and built_at > last_modified:
+        last_modified = built_at
+    return etag, last_modified
+
+
+def conditional_catalog_page(view):
+    """Отвечаем 304 на условный GET еще до запросов к каталогу"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Страницы с flash-сообщениями всегда рендерим заново
+        validators = None if session.get('_flashes') else catalog_validators()
+        if validators is None:
+            return view(*args, **kwargs)
+        etag, last_modified = validators
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            # Last-Modified не учитывает пользователя, поэтому только для анонимных
+            not_modified = (not get_current_user_id() and request.if_modified_since is not None
+                            and last_modified <= request.if_modified_since)
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            # Заглушку после ошибки БД клиент кэшировать не должен
+            if response.status_code != 200 or g.get('catalog_page_failed'):
+                return response
+
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        if get_current_user_id():
+            response.cache_control.private = True
+        response.vary.add('Cookie')
+        return response
+
+    return wrapper
 
 
 def get_current_user_id():
@@ -35,86 +298,81 @@ def get_current_user_id():
     return session.get('user_id')
 
 
+def load_user_profile(user_id):
+    """Профиль пользователя из БД или None, если пользователя нет"""
+    user = repository.fetch_one(get_db_connection(), 'user_profile', user_id)
+    if not user:
+        return None
+    return {
+        'id': user.id,
+        'email': user.email,
+        'имя': user.first_name,
+        'фамилия': user.last_name,
+        'адрес': user.address
+    }
+
+
 def get_current_user_info():
-    """Получаем информацию о текущем пользователе"""
+    """Получаем информацию о текущем пользователе.
+
+    Профиль берется из user_cache и запоминается на время запроса,
+    в БД идем только при промахе кэша.
+    """
     user_id = get_current_user_id()
     if not user_id:
         return None
 
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT id, email, имя, фамилия FROM "user" WHERE id = %s;', (user_id,))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
-
-        if user:
-            return {
-                'id': user[0],
-                'email': user[1],
-                'имя': user[2],
-                'фамилия': user[3]
-            }
-    except Exception as e:
-        print(f"Ошибка при получении информации о пользователе: {e}")
-
-    return None
+    if 'current_user' not in g:
+        user = user_cache.get(user_id)
+        if user is None:
+            try:
+                user = load_user_profile(user_id)
+            except Exception:
+                logger.exception("Ошибка при получении информации о пользователе")
+                return None
+            # Отсутствующего пользователя не кэшируем
+            if user is not None:
+                user_cache.set(user_id, user)
+        g.current_user = user
+    return g.current_user
 
 
 # Главная страница
 @app.route('/')
 def index():
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return render_template('index.html', products=[], reviews=[])
-
-        cur = conn.cursor()
+    # Для анонимных посетителей страница одинакова, отдаем готовый HTML
+    anonymous = not get_current_user_id()
+    if anonymous:
+        cached_page = page_cache.get('index')
+        if cached_page is not None:
+            return cached_page
 
+    try:
         # Получаем популярные товары
-        cur.execute('''
+        products = fetch_catalog(('home_products',), '''
             SELECT p.id, p.название, p.цена, p.цвет, c.название as категория, p.изображение 
             FROM product p 
             JOIN category c ON p.категория_id = c.id 
             WHERE p.активен = True 
             LIMIT 4;
         ''')
-        products = cur.fetchall()
 
-        # Получаем одобренные отзывы с информацией о пользователях и товарах
-        cur.execute('''
-            SELECT 
-                r.комментарий,
-                r.рейтинг,
-                r.дата_создания,
-                u.имя,
-                u.фамилия,
-                p.название as товар
-            FROM review r
-            JOIN "user" u ON r.пользователь_id = u.id
-            JOIN product p ON r.товар_id = p.id
-            WHERE r.одобрен = true
-            ORDER BY r.дата_создания DESC
-            LIMIT 3;
-        ''')
-        reviews = cur.fetchall()
+        conn = get_db_connection()
+        if not conn:
+            return render_template('index.html', products=products, reviews=[])
 
-        # выводим информацию об отзывах
-        print(f"=== ОТЗЫВЫ НА ГЛАВНОЙ ===")
-        print(f"Найдено отзывов: {len(reviews)}")
-        for i, review in enumerate(reviews):
-            print(f"Отзыв {i + 1}: {review[3]} {review[4]} - {review[5]} - Рейтинг: {review[1]}")
+        # Получаем одобренные отзывы с информацией о пользователях и товарах
+        reviews = repository.fetch_all(conn, 'approved_reviews', 3)
 
-        cur.close()
-        conn.close()
+        logger.debug("Отзывов на главной: %d", len(reviews))
 
-        return render_template('index.html', products=products, reviews=reviews)
+        page = render_template('index.html', products=products, reviews=reviews)
+        if anonymous:
+            page_cache.set('index', page)
+        return page
 
-    except Exception as e:
-        print(f"Ошибка БД в главной странице: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Ошибка БД в главной странице")
         return render_template('index.html', products=[], reviews=[])
 
 # Добавление отзыва
@@ -136,28 +394,62 @@ def add_review(product_id):
         conn = get_db_connection()
         cur = conn.cursor()
 
-        # Находим максимальный ID
-        cur.execute('SELECT COALESCE(MAX(id), 0) FROM review;')
-        max_id = cur.fetchone()[0]
-        new_id = max_id + 1
-
-        # Добавляем отзыв (по умолчанию не одобрен)
+        # Добавляем отзыв (по умолчанию не одобрен), id выдает последовательность
         cur.execute('''
-            INSERT INTO review (id, пользователь_id, товар_id, рейтинг, комментарий, дата_создания, одобрен)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ''', (new_id, user_id, product_id, rating, comment, datetime.now(), False))
+            INSERT INTO review (пользователь_id, товар_id, рейтинг, комментарий, дата_создания, одобрен)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (user_id, product_id, rating, comment, datetime.now(), False))
 
         conn.commit()
         cur.close()
-        conn.close()
 
         flash('Спасибо за ваш отзыв! Он будет опубликован после проверки.', 'success')
         return redirect(url_for('product_detail', product_id=product_id))
 
-    except Exception as e:
-        print(f"Ошибка при добавлении отзыва: {e}")
+    except Exception:
+        logger.exception("Ошибка при добавлении отзыва")
         flash('Ошибка при добавлении отзыва', 'error')
         return redirect(url_for('product_detail', product_id=product_id))
+
+
+# Хэширование паролей в ограниченном пуле потоков, чтобы вход и регистрация
+# не занимали все ядра воркера
+password_hasher = PasswordHasher(
+    workers=int(os.getenv('AUTH_HASH_WORKERS', 2)),
+    max_pending=int(os.getenv('AUTH_HASH_QUEUE', 8)),
+    timeout=float(os.getenv('AUTH_HASH_TIMEOUT', 10)),
+)
+
+# Попыток входа и регистрации в минуту с одного IP и на один email на весь сервер.
+# Корзины токенов у каждого воркера свои, поэтому лимит делится на число
+# воркеров gunicorn (WEB_CONCURRENCY): иначе фактический лимит в N раз больше
+AUTH_IP_PER_MINUTE = float(os.getenv('AUTH_IP_PER_MINUTE', 30))
+AUTH_EMAIL_PER_MINUTE = float(os.getenv('AUTH_EMAIL_PER_MINUTE', 6))
+AUTH_LIMIT_WORKERS = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+auth_ip_limiter = RateLimiter(rate=AUTH_IP_PER_MINUTE / 60 / AUTH_LIMIT_WORKERS,
+                              burst=max(1.0, AUTH_IP_PER_MINUTE / AUTH_LIMIT_WORKERS))
+auth_email_limiter = RateLimiter(rate=AUTH_EMAIL_PER_MINUTE / 60 / AUTH_LIMIT_WORKERS,
+                                 burst=max(1.0, AUTH_EMAIL_PER_MINUTE / AUTH_LIMIT_WORKERS))
+
+
+def auth_throttle_wait(email):
+    """Сколько секунд ждать до следующей попытки входа или регистрации (0 - можно сейчас)"""
+    wait = auth_ip_limiter.hit(request.remote_addr)
+    if not wait:
+        wait = auth_email_limiter.hit(email.strip().lower())
+    if wait:
+        logger.warning("Слишком частые попытки %s: ip %s, email %s", request.path, request.remote_addr, email)
+    return wait
+
+
+def auth_refused(template, status, retry_after, message):
+    """Страница входа или регистрации с отказом (429 или 503) и заголовком Retry-After"""
+    flash(message, 'error')
+    response = make_response(render_template(template), status)
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
 # Страница регистрации
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -176,6 +468,11 @@ def register():
                 flash('Заполните все обязательные поля', 'error')
                 return render_template('register.html')
 
+            wait = auth_throttle_wait(email)
+            if wait:
+                return auth_refused('register.html', 429, wait,
+                                    f'Слишком много попыток, повторите через {math.ceil(wait)} с')
+
             conn = get_db_connection()
             if not conn:
                 flash('Ошибка подключения к базе данных', 'error')
@@ -192,29 +489,26 @@ def register():
                 return render_template('register.html')
 
             # Хэшируем пароль
-            hashed_password = generate_password_hash(password)
-
-            # Находим максимальный ID
-            cur.execute('SELECT COALESCE(MAX(id), 0) FROM "user";')
-            max_id = cur.fetchone()[0]
-            new_id = max_id + 1
+            hashed_password = password_hasher.hash(password)
 
-            # Создаем нового пользователя
+            # Создаем нового пользователя, id выдает последовательность
             cur.execute('''
-                INSERT INTO "user" (id, email, пароль, имя, фамилия, телефон, адрес, дата_регистрации) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-            ''', (new_id, email, hashed_password, first_name, last_name, phone, address, datetime.now()))
+                INSERT INTO "user" (email, пароль, имя, фамилия, телефон, адрес, дата_регистрации) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s);
+            ''', (email, hashed_password, first_name, last_name, phone, address, datetime.now()))
 
             conn.commit()
             flash('Регистрация успешна! Теперь вы можете войти.', 'success')
 
             cur.close()
-            conn.close()
 
             return redirect(url_for('login'))
 
-        except Exception as e:
-            print(f"Ошибка при регистрации: {e}")
+        except Overloaded:
+            logger.warning("Пул хэширования паролей перегружен, регистрация отклонена")
+            return auth_refused('register.html', 503, 5, 'Сервер перегружен, попробуйте через несколько секунд')
+        except Exception:
+            logger.exception("Ошибка при регистрации")
             flash('Ошибка при регистрации', 'error')
 
     return render_template('register.html')
@@ -233,6 +527,11 @@ def login():
                 flash('Введите email и пароль', 'error')
                 return render_template('login.html')
 
+            wait = auth_throttle_wait(email)
+            if wait:
+                return auth_refused('login.html', 429, wait,
+                                    f'Слишком много попыток входа, повторите через {math.ceil(wait)} с')
+
             conn = get_db_connection()
             if not conn:
                 flash('Ошибка подключения к базе данных', 'error')
@@ -240,62 +539,55 @@ def login():
 
             cur = conn.cursor()
 
-            # Ищем пользователя по email
-            cur.execute('SELECT id, email, пароль, имя, фамилия FROM "user" WHERE email = %s;', (email,))
+            # Ищем пользователя по email, заодно берем сводку его корзины для сессии
+            cur.execute('''
+                SELECT u.id, u.email, u.пароль, u.имя, u.фамилия, s.lines, s.items, s.subtotal
+                FROM "user" u
+                LEFT JOIN cart_summary s ON s.пользователь_id = u.id
+                WHERE u.email = %s;
+            ''', (email,))
             user = cur.fetchone()
 
+            # Хэши проверяются в пуле хэширования. Пароли в открытом виде остаются,
+            # пока rehash_passwords.py не прошел по всей таблице: такой пароль
+            # сравнивается напрямую и при успешном входе сразу заменяется хэшем
             if user:
                 stored_password = user[2]
-
-                # Проверяем, хэширован ли уже пароль
-                # Если пароль не начинается с типичного префикса хэша, считаем его незашифрованным
-                if stored_password.startswith('pbkdf2:') or stored_password.startswith(
-                        'scrypt:') or stored_password.startswith('$2b$'):
-                    # Пароль хэширован, проверяем через check_password_hash
-                    if check_password_hash(stored_password, password):
-                        # Успешный вход
-                        session['user_id'] = user[0]
-                        session['user_email'] = user[1]
-                        session['user_name'] = user[3]
-
-                        flash(f'Добро пожаловать, {user[3]}!', 'success')
-
-                        cur.close()
-                        conn.close()
-
-                        return redirect(url_for('index'))
-                    else:
-                        flash('Неверный email или пароль', 'error')
+                if stored_password.startswith(HASH_PREFIXES):
+                    valid = password_hasher.verify(stored_password, password)
                 else:
-                    # Пароль не хэширован, проверяем напрямую
-                    if stored_password == password:
-                        # Успешный вход, но нужно обновить пароль на хэшированный
-                        hashed_password = generate_password_hash(password)
-                        cur.execute('UPDATE "user" SET пароль = %s WHERE id = %s;', (hashed_password, user[0]))
+                    valid = hmac.compare_digest(stored_password.encode(), password.encode())
+                    if valid:
+                        # Условие на старый пароль: не затираем хэш, записанный rehash_passwords.py
+                        cur.execute('UPDATE "user" SET пароль = %s WHERE id = %s AND пароль = %s;',
+                                    (password_hasher.hash(password), user[0], stored_password))
                         conn.commit()
+                        invalidate_user(user[0])
 
-                        # Устанавливаем сессию
-                        session['user_id'] = user[0]
-                        session['user_email'] = user[1]
-                        session['user_name'] = user[3]
+                if valid:
+                    # Успешный вход
+                    session['user_id'] = user[0]
+                    session['user_email'] = user[1]
+                    session['user_name'] = user[3]
+                    remember_cart_summary(user[5:8] if user[5] is not None else None)
 
-                        flash(f'Добро пожаловать, {user[3]}! Пароль обновлен для безопасности.', 'success')
+                    flash(f'Добро пожаловать, {user[3]}!', 'success')
 
-                        cur.close()
-                        conn.close()
+                    cur.close()
 
-                        return redirect(url_for('index'))
-                    else:
-                        flash('Неверный email или пароль', 'error')
+                    return redirect(url_for('index'))
+                else:
+                    flash('Неверный email или пароль', 'error')
             else:
                 flash('Неверный email или пароль', 'error')
 
             cur.close()
-            conn.close()
 
-        except Exception as e:
-            print(f"Ошибка при входе: {e}")
-            print(traceback.format_exc())
+        except Overloaded:
+            logger.warning("Пул хэширования паролей перегружен, вход отклонен")
+            return auth_refused('login.html', 503, 5, 'Сервер перегружен, попробуйте через несколько секунд')
+        except Exception:
+            logger.exception("Ошибка при входе")
             flash('Ошибка при входе', 'error')
 
     return render_template('login.html')
@@ -308,6 +600,55 @@ def logout():
     return redirect(url_for('index'))
 
 
+def remember_cart_summary(summary):
+    """Копируем сводку корзины (строк, товаров, сумма) в сессию.
+
+    Значок корзины и проверки пустой корзины читают сессию, а не базу.
+    """
+    lines, items, subtotal = summary or (0, 0, 0)
+    session['cart_items_count'] = lines
+    session['cart_quantity'] = items
+    session['cart_subtotal'] = str(subtotal)
+
+
+def add_product_to_cart(cur, user_id, product_id):
+    """Добавляем товар в корзину одним запросом.
+
+    Возвращает (id строки корзины, строк в корзине, товаров, сумма) или None,
+    если товар не найден или неактивен.
+    """
+    # Вставка или увеличение количества атомарно по (пользователь, товар),
+    # сводка корзины (миграция cart_summary) меняется в том же запросе
+    cur.execute('''
+        WITH upsert AS (
+            INSERT INTO cart (пользователь_id, товар_id, количество, дата_добавления)
+            SELECT %s, p.id, 1, %s
+            FROM product p
+            WHERE p.id = %s AND p.активен = True
+            ON CONFLICT (пользователь_id, товар_id)
+            DO UPDATE SET количество = cart.количество + 1,
+                          дата_добавления = EXCLUDED.дата_добавления
+            RETURNING id, товар_id, (xmax = 0) AS inserted
+        ),
+        summary AS (
+            INSERT INTO cart_summary AS s (пользователь_id, lines, items, subtotal)
+            SELECT %s, CASE WHEN u.inserted THEN 1 ELSE 0 END, 1, p.цена
+            FROM upsert u
+            JOIN product p ON p.id = u.товар_id
+            ON CONFLICT (пользователь_id) DO UPDATE
+            SET lines = s.lines + EXCLUDED.lines,
+                items = s.items + EXCLUDED.items,
+                subtotal = s.subtotal + EXCLUDED.subtotal,
+                updated_at = now()
+            RETURNING lines, items, subtotal
+        )
+        SELECT u.id, s.lines, s.items, s.subtotal
+        FROM upsert u
+        CROSS JOIN summary s;
+    ''', (user_id, datetime.now(), product_id, user_id))
+    return cur.fetchone()
+
+
 # Добавление товара в корзину (сохраняем в БД)
 @app.route('/add_to_cart/<int:product_id>')
 def add_to_cart(product_id):
@@ -317,88 +658,66 @@ def add_to_cart(product_id):
         return redirect(url_for('login'))
 
     try:
-        print(f"=== ПОПЫТКА ДОБАВИТЬ В КОРЗИНУ ===")
-        print(f"Товар ID: {product_id}, Пользователь ID: {user_id}")
-
         conn = get_db_connection()
         if not conn:
             flash('Ошибка подключения к базе данных', 'error')
             return redirect(request.referrer or url_for('index'))
 
         cur = conn.cursor()
+        result = add_product_to_cart(cur, user_id, product_id)
+        conn.commit()
+        cur.close()
 
-        # 1. Проверяем существование пользователя
-        cur.execute('SELECT id, имя FROM "user" WHERE id = %s;', (user_id,))
-        user = cur.fetchone()
-        if not user:
-            print(f" Пользователь с ID {user_id} не найден!")
-            flash('Пользователь не найден', 'error')
-            return redirect(request.referrer or url_for('index'))
-        print(f" Пользователь найден: {user[1]}")
-
-        # 2. Проверяем существование товара
-        cur.execute('SELECT id, название, цена, активен FROM product WHERE id = %s;', (product_id,))
-        product = cur.fetchone()
-
-        if not product:
-            print("❌ Товар не найден!")
-            flash('Товар не найден', 'error')
+        if not result:
+            logger.debug("Товар %s не найден или не активен", product_id)
+            flash('Товар не найден или временно недоступен', 'error')
             return redirect(request.referrer or url_for('index'))
 
-        print(f"✅ Товар найден: {product[1]}, цена: {product[2]}, активен: {product[3]}")
+        remember_cart_summary(result[1:])
+        logger.debug("Товар %s добавлен в корзину пользователя %s, строк в корзине: %d",
+                     product_id, user_id, result[1])
+        flash('Товар добавлен в корзину!', 'success')
 
-        if not product[3]:  # если не активен
-            print("❌ Товар не активен!")
-            flash('Товар временно недоступен', 'error')
-            return redirect(request.referrer or url_for('index'))
+    except Exception:
+        logger.exception("Ошибка при добавлении в корзину")
+        flash('Ошибка при добавлении товара в корзину', 'error')
 
-        # 3. Проверяем, есть ли товар уже в корзине пользователя
-        cur.execute('''
-            SELECT id, количество FROM cart 
-            WHERE пользователь_id = %s AND товар_id = %s;
-        ''', (user_id, product_id))
+    return redirect(request.referrer or url_for('index'))
 
-        existing_item = cur.fetchone()
 
-        if existing_item:
-            # Увеличиваем количество
-            new_quantity = existing_item[1] + 1
-            cur.execute('''
-                UPDATE cart SET количество = %s, дата_добавления = %s 
-                WHERE id = %s;
-            ''', (new_quantity, datetime.now(), existing_item[0]))
-            print(f"🔄 Увеличили количество товара до {new_quantity}")
-        else:
-            # Добавляем новый товар в корзину
-            # Сначала найдем максимальный ID в корзине
-            cur.execute('SELECT COALESCE(MAX(id), 0) FROM cart;')
-            max_id = cur.fetchone()[0]
-            new_id = max_id + 1
+# Добавление товара в корзину без перезагрузки страницы
+@app.route('/api/cart/add/<int:product_id>', methods=['POST'])
+def api_add_to_cart(product_id):
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({'error': 'Unauthorized'}), 401
 
-            cur.execute('''
-                INSERT INTO cart (id, пользователь_id, товар_id, количество, дата_добавления) 
-                VALUES (%s, %s, %s, %s, %s);
-            ''', (new_id, user_id, product_id, 1, datetime.now()))
-            print(f"✅ Добавили новый товар в корзину. ID записи: {new_id}")
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Ошибка подключения к базе данных'}), 503
 
+        cur = conn.cursor()
+        result = add_product_to_cart(cur, user_id, product_id)
         conn.commit()
-        print("✅ Изменения сохранены в БД")
-        flash('Товар добавлен в корзину!', 'success')
-
-        # Проверим что действительно добавилось
-        cur.execute('SELECT COUNT(*) FROM cart WHERE пользователь_id = %s;', (user_id,))
-        cart_count = cur.fetchone()[0]
-        print(f"📊 Теперь в корзине пользователя {user_id} товаров: {cart_count}")
-
         cur.close()
-        conn.close()
 
-    except Exception as e:
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА при добавлении в корзину:")
-        print(traceback.format_exc())
-        flash('Ошибка при добавлении товара в корзину', 'error')
+        if not result:
+            return jsonify({'error': 'Товар не найден или временно недоступен'}), 404
 
-    return redirect(request.referrer or url_for('index'))
+        cart_item_id, cart_count, cart_quantity, cart_subtotal = result
+        remember_cart_summary(result[1:])
+
+        return jsonify({
+            'cart_item_id': cart_item_id,
+            'cart_items_count': cart_count,
+            'cart_quantity': cart_quantity,
+            'cart_subtotal': str(cart_subtotal)
+        })
+
+    except Exception:
+        logger.exception("Ошибка в API добавления в корзину")
+        return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
 
 
 # Страница корзины
@@ -410,56 +729,23 @@ def view_cart():
         return redirect(url_for('login'))
 
     try:
-        print(f"=== ЗАПРОС КОРЗИНЫ ===")
-        print(f"Пользователь: {user_id}")
-
         conn = get_db_connection()
         if not conn:
-            print("❌ Нет подключения к БД")
             return render_template('cart.html', cart_items=[], total=0)
 
-        cur = conn.cursor()
-
-        # Сначала проверим простой запрос
-        cur.execute('SELECT COUNT(*) FROM cart WHERE пользователь_id = %s;', (user_id,))
-        simple_count = cur.fetchone()[0]
-        print(f"📊 Простой подсчет товаров в корзине: {simple_count}")
-
         # Получаем корзину пользователя с информацией о товарах
-        cur.execute('''
-            SELECT 
-                c.id as cart_id,
-                c.товар_id,
-                c.количество,
-                c.дата_добавления,
-                p.название,
-                p.цена,
-                p.цвет,
-                cat.название as категория
-            FROM cart c
-            JOIN product p ON c.товар_id = p.id
-            JOIN category cat ON p.категория_id = cat.id
-            WHERE c.пользователь_id = %s
-            ORDER BY c.дата_добавления DESC;
-        ''', (user_id,))
-
-        cart_items = cur.fetchall()
-
-        print(f" Найдено товаров в корзине: {len(cart_items)}")
-        for item in cart_items:
-            print(f"   - {item[4]} (количество: {item[2]})")
+        cart_items = repository.fetch_all(conn, 'cart_items', user_id)
 
         # Рассчитываем общую сумму
-        total = sum(item[5] * item[2] for item in cart_items)  # цена * количество
+        total = sum(item.price * item.quantity for item in cart_items)
 
-        cur.close()
-        conn.close()
+        # Корзина прочитана целиком - обновляем копию сводки в сессии по фактическим данным
+        remember_cart_summary((len(cart_items), sum(item.quantity for item in cart_items), total))
 
         return render_template('cart.html', cart_items=cart_items, total=total)
 
-    except Exception as e:
-        print(f"❌ Ошибка при загрузке корзины: {e}")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("Ошибка при загрузке корзины")
         return render_template('cart.html', cart_items=[], total=0)
 
 
@@ -475,19 +761,35 @@ def remove_from_cart(cart_item_id):
         conn = get_db_connection()
         cur = conn.cursor()
 
-        print(f"Удаляем товар из корзины: cart_item_id = {cart_item_id}")
-
-        cur.execute('DELETE FROM cart WHERE id = %s AND пользователь_id = %s;',
-                    (cart_item_id, user_id))
+        # Удаление строки и вычитание ее из сводки корзины одним запросом.
+        # Опустевшая корзина обнуляет сводку целиком, чтобы не копилась погрешность от смены цен.
+        cur.execute('''
+            WITH removed AS (
+                DELETE FROM cart c
+                USING product p
+                WHERE c.id = %s AND c.пользователь_id = %s AND p.id = c.товар_id
+                RETURNING c.количество, p.цена
+            )
+            UPDATE cart_summary s
+            SET lines = s.lines - 1,
+                items = CASE WHEN s.lines > 1 THEN s.items - r.количество ELSE 0 END,
+                subtotal = CASE WHEN s.lines > 1 THEN s.subtotal - r.количество * r.цена ELSE 0 END,
+                updated_at = now()
+            FROM removed r
+            WHERE s.пользователь_id = %s
+            RETURNING s.lines, s.items, s.subtotal;
+        ''', (cart_item_id, user_id, user_id))
+        summary = cur.fetchone()
 
         conn.commit()
+        if summary:
+            remember_cart_summary(summary)
         flash('Товар удален из корзины', 'success')
 
         cur.close()
-        conn.close()
 
-    except Exception as e:
-        print(f"Ошибка при удалении из корзины: {e}")
+    except Exception:
+        logger.exception("Ошибка при удалении из корзины")
         flash('Ошибка при удалении товара', 'error')
 
     return redirect(url_for('view_cart'))
@@ -504,8 +806,6 @@ def update_cart_quantity(cart_item_id):
     try:
         new_quantity = int(request.form['quantity'])
 
-        print(f"Обновляем количество товара {cart_item_id} на {new_quantity}")
-
         if new_quantity <= 0:
             # Если количество 0 или меньше, удаляем товар
             return redirect(url_for('remove_from_cart', cart_item_id=cart_item_id))
@@ -513,131 +813,294 @@ def update_cart_quantity(cart_item_id):
         conn = get_db_connection()
         cur = conn.cursor()
 
+        # Новое количество и разница в сводке корзины одним запросом
         cur.execute('''
-            UPDATE cart SET количество = %s, дата_добавления = %s 
-            WHERE id = %s AND пользователь_id = %s;
-        ''', (new_quantity, datetime.now(), cart_item_id, user_id))
+            WITH old AS (
+                SELECT c.id, c.количество, p.цена
+                FROM cart c
+                JOIN product p ON p.id = c.товар_id
+                WHERE c.id = %s AND c.пользователь_id = %s
+                FOR UPDATE OF c
+            ),
+            updated AS (
+                UPDATE cart c SET количество = %s, дата_добавления = %s
+                FROM old o
+                WHERE c.id = o.id
+                RETURNING c.количество - o.количество AS delta, o.цена
+            )
+            UPDATE cart_summary s
+            SET items = s.items + u.delta,
+                subtotal = s.subtotal + u.delta * u.цена,
+                updated_at = now()
+            FROM updated u
+            WHERE s.пользователь_id = %s
+            RETURNING s.lines, s.items, s.subtotal;
+        ''', (cart_item_id, user_id, new_quantity, datetime.now(), user_id))
+        summary = cur.fetchone()
 
         conn.commit()
+        if summary:
+            remember_cart_summary(summary)
         flash('Количество товара обновлено', 'success')
 
         cur.close()
-        conn.close()
 
-    except Exception as e:
-        print(f"Ошибка при обновлении корзины: {e}")
+    except Exception:
+        logger.exception("Ошибка при обновлении корзины")
         flash('Ошибка при обновлении количества', 'error')
 
     return redirect(url_for('view_cart'))
 
 
+# Размер страницы каталога
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', 24))
+
+# Сортировки каталога: ключи keyset-пагинации (последний - id для уникальности),
+# их позиции в строке товара и направление
+CATALOG_SORTS = {
+    'newest': (('p.id',), (0,), 'DESC'),
+    'price': (('p.цена', 'p.id'), (2, 0), 'ASC'),
+    'name': (('p.название', 'p.id'), (1, 0), 'ASC'),
+}
+CATALOG_DEFAULT_SORT = 'newest'
+
+
+def encode_catalog_cursor(values):
+    """Курсор каталога: значения ключей сортировки в base64(JSON)"""
+    raw = json.dumps([str(value) if not isinstance(value, (int, str)) else value for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_catalog_cursor(token, size):
+    """Разбираем курсор каталога, при ошибке возвращаем None"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return tuple(values)
+
+
+def load_catalog_page(category_id, sort, cursor, backward):
+    """Страница активных товаров категории (None - все товары) по курсору"""
+    keys, _, direction = CATALOG_SORTS[sort]
+
+    # Назад идем в обратном порядке, потом разворачиваем страницу
+    if backward:
+        direction = 'DESC' if direction == 'ASC' else 'ASC'
+    comparison = '>' if direction == 'ASC' else '<'
+
+    conditions = ['p.активен = True']
+    params = []
+    if category_id:
+        conditions.append('p.категория_id = %s')
+        params.append(category_id)
+    if cursor:
+        placeholders = ', '.join(['%s'] * len(keys))
+        conditions.append(f"({', '.join(keys)}) {comparison} ({placeholders})")
+        params.extend(cursor)
+    params.append(CATALOG_PAGE_SIZE + 1)
+
+    # Ключи и направления берутся только из CATALOG_SORTS, пользовательский ввод идет параметрами
+    sql = f'''
+        SELECT p.id, p.название, p.цена, p.цвет, c.название as категория, p.изображение  
+        FROM product p 
+        JOIN category c ON p.категория_id = c.id 
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {', '.join(f'{key} {direction}' for key in keys)}
+        LIMIT %s;
+    '''
+
+    cache_key = ('products', category_id, sort, cursor, backward)
+    rows = fetch_catalog(cache_key, sql, tuple(params),
+                         cache=listing_cache if cursor else catalog_cache)
+
+    has_more = len(rows) > CATALOG_PAGE_SIZE
+    rows = list(rows[:CATALOG_PAGE_SIZE])
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
 # Каталог товаров с фильтрацией по категориям
 @app.route('/catalog')
 @app.route('/catalog/<int:category_id>')
+@conditional_catalog_page
 def catalog(category_id=None):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         # Получаем все активные категории
-        cur.execute('''
+        categories = fetch_catalog(('categories',), '''
             SELECT id, название, родительская_категория 
             FROM category 
             WHERE активна = True 
             ORDER BY название;
         ''')
-        categories = cur.fetchall()
 
-        # Получаем товары
-        if category_id == 1:  # ID категории "Вся одежда"
-            # Показываем ВСЕ товары
-            cur.execute('''
-                SELECT p.id, p.название, p.цена, p.цвет, c.название as категория, p.изображение  
-                FROM product p 
-                JOIN category c ON p.категория_id = c.id 
-                WHERE p.активен = True;
-            ''')
-        elif category_id:
-            # Показываем товары только этой категории
-            cur.execute('''
-                SELECT p.id, p.название, p.цена, p.цвет, c.название as категория, p.изображение  
-                FROM product p 
-                JOIN category c ON p.категория_id = c.id 
-                WHERE p.активен = True AND p.категория_id = %s;
-            ''', (category_id,))
-        else:
-            # Главная страница каталога - тоже показываем все товары
-            cur.execute('''
-                SELECT p.id, p.название, p.цена, p.цвет, c.название as категория, p.изображение  
-                FROM product p 
-                JOIN category c ON p.категория_id = c.id 
-                WHERE p.активен = True;
-            ''')
+        sort = request.args.get('sort')
+        if sort not in CATALOG_SORTS:
+            sort = CATALOG_DEFAULT_SORT
+        _, key_positions, _ = CATALOG_SORTS[sort]
+
+        # after - следующая страница, before - предыдущая
+        before = decode_catalog_cursor(request.args.get('before'), len(key_positions))
+        after = decode_catalog_cursor(request.args.get('after'), len(key_positions)) if not before else None
+
+        # 1 - ID категории "Вся одежда", показываем все товары, как и на главной странице каталога
+        products_category_id = category_id if category_id != 1 else None
+        products, has_more = load_catalog_page(products_category_id, sort, before or after, bool(before))
 
-        products = cur.fetchall()
+        def cursor_for(product):
+            return encode_catalog_cursor([product[i] for i in key_positions])
+
+        next_cursor = None
+        prev_cursor = None
+        if products:
+            if has_more or before:
+                next_cursor = cursor_for(products[-1])
+            if (before and has_more) or after:
+                prev_cursor = cursor_for(products[0])
 
         # Получаем название текущей категории
         current_category_name = "Все товары"
         if category_id:
-            cur.execute('SELECT название FROM category WHERE id = %s;', (category_id,))
-            category_result = cur.fetchone()
+            category_result = fetch_catalog(('category_name', category_id),
+                                            'SELECT название FROM category WHERE id = %s;',
+                                            (category_id,), one=True)
             if category_result:
                 current_category_name = category_result[0]
 
-        cur.close()
-        conn.close()
-
         return render_template('catalog.html',
                                products=products,
                                categories=categories,
                                current_category_id=category_id,
-                               current_category_name=current_category_name)
-
-    except Exception as e:
-        print(f"Ошибка БД: {e}")
+                               current_category_name=current_category_name,
+                               sort=sort,
+                               next_cursor=next_cursor,
+                               prev_cursor=prev_cursor)
+
+    except Exception:
+        logger.exception("Ошибка БД в каталоге")
+        g.catalog_page_failed = True
         return render_template('catalog.html', products=[], categories=[])
 
 
+# Поиск товаров: минимальная длина запроса и размер выдачи
+SEARCH_MIN_LENGTH = 2
+SEARCH_LIMIT = 40
+
+
+def build_search_tsquery(query):
+    """Строка для to_tsquery: все слова запроса с совпадением по префиксу"""
+    return ' & '.join(f'{term}:*' for term in query.split())
+
+
+def normalize_search_query(query):
+    """Слова запроса в нижнем регистре через пробел, без знаков препинания"""
+    return ' '.join(re.findall(r'[^\W_]+', query.lower()))
+
+
+def search_products(query, limit):
+    """Ищем активные товары по индексу product_search (миграция product_search).
+
+    Полнотекстовый поиск дает префиксы и ранжирование, триграммы - устойчивость к опечаткам.
+    """
+    # "Платье  красное!" и "платье красное" - один запрос и одна запись кэша
+    query = normalize_search_query(query)
+    tsquery = build_search_tsquery(query)
+    if not tsquery:
+        return []
+
+    # Строки в том же формате, что и в каталоге, плюс ранг последним полем
+    return fetch_catalog(('search', query, limit), '''
+        SELECT 
+            p.id, p.название, p.цена, p.цвет, c.название as категория, p.изображение,
+            ts_rank_cd(ps.document, q.tsq) + word_similarity(%(text)s, ps.search_text) AS rank
+        FROM product_search ps
+        CROSS JOIN to_tsquery('russian', %(tsquery)s) AS q(tsq)
+        JOIN product p ON p.id = ps.product_id
+        JOIN category c ON p.категория_id = c.id
+        WHERE p.активен = True
+            AND (ps.document @@ q.tsq OR %(text)s <%% ps.search_text)
+        ORDER BY rank DESC, p.id
+        LIMIT %(limit)s;
+    ''', {'text': query, 'tsquery': tsquery, 'limit': limit}, cache=search_cache)
+
+
+# Страница поиска
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    products = []
+
+    try:
+        if len(query) >= SEARCH_MIN_LENGTH:
+            products = search_products(query, SEARCH_LIMIT)
+    except Exception:
+        logger.exception("Ошибка при поиске товаров")
+        flash('Ошибка при поиске товаров', 'error')
+
+    return render_template('search.html', query=query, products=products)
+
+
+# Поиск для автодополнения
+@app.route('/api/search')
+def api_search():
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 8, type=int), SEARCH_LIMIT))
+
+    if len(query) < SEARCH_MIN_LENGTH:
+        return jsonify({'query': query, 'results': []})
+
+    try:
+        products = search_products(query, limit)
+    except Exception:
+        logger.exception("Ошибка в API поиска")
+        return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+
+    return jsonify({
+        'query': query,
+        'results': [{
+            'id': product[0],
+            'name': product[1],
+            'price': float(product[2]),
+            'category': product[4],
+            'url': url_for('product_detail', product_id=product[0])
+        } for product in products]
+    })
+
+
 # Страница товара
 @app.route('/product/<int:product_id>')
+@conditional_catalog_page
 def product_detail(product_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         # Получаем информацию о товаре (без описания, т.к. его нет в таблице)
-        cur.execute('''
-            SELECT p.id, p.название, p.цена, p.цвет, p.размер, p.изображение, c.название as категория 
-            FROM product p 
-            JOIN category c ON p.категория_id = c.id 
-            WHERE p.id = %s AND p.активен = True;
-        ''', (product_id,))
-        product = cur.fetchone()
+        product = catalog_cache.get_or_load(
+            ('product', product_id),
+            lambda: repository.fetch_one(get_db_connection(), 'product_detail', product_id))
 
         if not product:
             flash('Товар не найден', 'error')
             return redirect(url_for('catalog'))
 
-        cur.close()
-        conn.close()
-
         return render_template('product_detail.html', product=product)
 
-    except Exception as e:
-        print(f"Ошибка при загрузке товара: {e}")
+    except Exception:
+        logger.exception("Ошибка при загрузке товара")
         flash('Ошибка при загрузке товара', 'error')
         return redirect(url_for('catalog'))
 
 
 # Страница всех категорий
 @app.route('/categories')
+@conditional_catalog_page
 def categories():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         # только нужные поля
-        cur.execute('''
+        categories = fetch_catalog(('categories_page',), '''
             SELECT 
                 id, 
                 название, 
@@ -647,15 +1110,12 @@ def categories():
             WHERE активна = True 
             ORDER BY родительская_категория NULLS FIRST, название;
         ''')
-        categories = cur.fetchall()
-
-        cur.close()
-        conn.close()
 
         return render_template('categories.html', categories=categories)
 
-    except Exception as e:
-        print(f"Ошибка БД в категориях: {e}")
+    except Exception:
+        logger.exception("Ошибка БД в категориях")
+        g.catalog_page_failed = True
         return render_template('categories.html', categories=[])
 
 
@@ -676,14 +1136,9 @@ def checkout():
 
         cur = conn.cursor()
 
-        # Проверяем, есть ли товары в корзине
-        cur.execute('SELECT COUNT(*) FROM cart WHERE пользователь_id = %s;', (user_id,))
-        cart_count = cur.fetchone()[0]
-
-        print(f"=== ОТЛАДКА CHECKOUT ===")
-        print(f"Пользователь: {user_id}, товаров в корзине: {cart_count}")
-
-        if cart_count == 0:
+        # Пустую корзину видно по сводке в сессии. Если сводка устарела,
+        # страница корзины перечитает ее из базы.
+        if session.get('cart_items_count') == 0:
             flash('Корзина пуста!', 'error')
             return redirect(url_for('view_cart'))
 
@@ -695,65 +1150,63 @@ def checkout():
                 flash('Введите адрес доставки', 'error')
                 return redirect(url_for('checkout'))
 
-            # Получаем товары из корзины для расчета суммы
-            cur.execute('''
-                SELECT 
-                    c.товар_id,
-                    c.количество,
-                    p.цена,
-                    p.название
-                FROM cart c
-                JOIN product p ON c.товар_id = p.id
-                WHERE c.пользователь_id = %s
-            ''', (user_id,))
-            cart_items = cur.fetchall()
-
-            print(f"Товары в корзине: {cart_items}")
-
-            total_amount = sum(item[2] * item[1] for item in cart_items)
-            print(f"Общая сумма: {total_amount}")
-
             # Создаем номер заказа
             order_number = f"ORD-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            print(f"Номер заказа: {order_number}")
 
-            # Находим максимальный ID для заказа
-            cur.execute('SELECT COALESCE(MAX(id), 0) FROM "order";')
-            max_order_id = cur.fetchone()[0]
-            new_order_id = max_order_id + 1
-            print(f"Новый ID заказа: {new_order_id}")
-
-            # Создаем заказ
+            # Весь заказ одним запросом: корзина удаляется, а из удаленных строк
+            # в той же транзакции создаются заказ (сумма считается в SQL) и order_items
             cur.execute('''
-                INSERT INTO "order" (id, пользователь_id, номер_заказа, статус, общая_сумма, адрес_доставки, дата_создания)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ''', (new_order_id, user_id, order_number, 'создан', total_amount, shipping_address, datetime.now()))
-
-            print(f"Заказ создан в таблице 'order'")
-
-            # Сохраняем товары в таблицу order_items
-            for item in cart_items:
-                product_id, quantity, price, product_name = item
-                print(f"Сохраняем товар: {product_name} (ID: {product_id}), количество: {quantity}, цена: {price}")
-
-                cur.execute('''
+                WITH cleared AS (
+                    DELETE FROM cart
+                    WHERE пользователь_id = %s
+                    RETURNING товар_id, количество
+                ),
+                lines AS (
+                    SELECT c.товар_id, c.количество, p.цена
+                    FROM cleared c
+                    JOIN product p ON c.товар_id = p.id
+                ),
+                new_order AS (
+                    INSERT INTO "order" (пользователь_id, номер_заказа, статус, общая_сумма, адрес_доставки, дата_создания)
+                    SELECT %s, %s, 'создан', SUM(l.количество * l.цена), %s, %s
+                    FROM lines l
+                    HAVING COUNT(*) > 0
+                    RETURNING id, общая_сумма
+                ),
+                items AS (
                     INSERT INTO order_items (order_id, product_id, quantity, price_at_order)
-                    VALUES (%s, %s, %s, %s)
-                ''', (new_order_id, product_id, quantity, price))
-
-            print(f"Товары сохранены в order_items")
-
-            # Очищаем корзину
-            cur.execute('DELETE FROM cart WHERE пользователь_id = %s;', (user_id,))
-            print(f"Корзина очищена")
-
+                    SELECT o.id, l.товар_id, l.количество, l.цена
+                    FROM new_order o
+                    CROSS JOIN lines l
+                    RETURNING 1
+                ),
+                summary AS (
+                    UPDATE cart_summary
+                    SET lines = 0, items = 0, subtotal = 0, updated_at = now()
+                    WHERE пользователь_id = %s
+                )
+                SELECT o.id, o.общая_сумма, (SELECT COUNT(*) FROM items)
+                FROM new_order o;
+            ''', (user_id, user_id, order_number, shipping_address, datetime.now(), user_id))
+            created = cur.fetchone()
+
+            if not created:
+                # Корзину успели очистить в другом запросе
+                conn.rollback()
+                remember_cart_summary(None)
+                flash('Корзина пуста!', 'error')
+                return redirect(url_for('view_cart'))
+
+            new_order_id, total_amount, items_count = created
+            sales_stats.record_order(cur, new_order_id, total_amount)
             conn.commit()
-            print(f"Транзакция завершена успешно")
+            remember_cart_summary(None)
+            logger.info("Создан заказ %s (%s): позиций %d, сумма %s",
+                        new_order_id, order_number, items_count, total_amount)
 
             flash('Заказ успешно создан! Теперь вы можете оплатить его.', 'success')
 
             cur.close()
-            conn.close()
 
             # Перенаправляем на страницу оплаты
             return redirect(url_for('payment', order_id=new_order_id))
@@ -761,39 +1214,29 @@ def checkout():
         else:
             # GET запрос - показываем форму оформления заказа
             # Получаем товары из корзины для отображения
-            cur.execute('''
-                SELECT 
-                    c.id as cart_id,
-                    c.товар_id,
-                    c.количество,
-                    p.название,
-                    p.цена,
-                    p.цвет
-                FROM cart c
-                JOIN product p ON c.товар_id = p.id
-                WHERE c.пользователь_id = %s
-            ''', (user_id,))
-            cart_items = cur.fetchall()
+            cart_items = repository.fetch_all(conn, 'cart_items', user_id)
 
-            total_amount = sum(item[4] * item[2] for item in cart_items)
+            if not cart_items:
+                remember_cart_summary(None)
+                flash('Корзина пуста!', 'error')
+                return redirect(url_for('view_cart'))
 
-            # Получаем адрес пользователя по умолчанию
-            cur.execute('SELECT адрес FROM "user" WHERE id = %s;', (user_id,))
-            user_address = cur.fetchone()
-            default_address = user_address[0] if user_address else ''
+            total_amount = sum(item.price * item.quantity for item in cart_items)
+            remember_cart_summary((len(cart_items), sum(item.quantity for item in cart_items), total_amount))
+
+            # Адрес пользователя по умолчанию - из кэша профилей
+            user = get_current_user_info()
+            default_address = (user or {}).get('адрес') or ''
 
             cur.close()
-            conn.close()
 
             return render_template('checkout.html',
                                    cart_items=cart_items,
                                    total_amount=total_amount,
                                    default_address=default_address)
 
-    except Exception as e:
-        print(f" КРИТИЧЕСКАЯ ОШИБКА при оформлении заказа: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Ошибка при оформлении заказа")
         flash('Ошибка при оформлении заказа', 'error')
         return redirect(url_for('view_cart'))
 
@@ -812,7 +1255,6 @@ def api_order_items(order_id):
         cur.execute('SELECT id FROM "order" WHERE id = %s AND пользователь_id = %s', (order_id, user_id))
         if not cur.fetchone():
             cur.close()
-            conn.close()
             return jsonify({'error': 'Order not found'}), 404
 
         # Получаем товары заказа
@@ -845,7 +1287,6 @@ def api_order_items(order_id):
         order_number = order_number_result[0] if order_number_result else f'Заказ #{order_id}'
 
         cur.close()
-        conn.close()
 
         return jsonify({
             'order_number': order_number,
@@ -853,9 +1294,31 @@ def api_order_items(order_id):
             'total': sum(item['total'] for item in items)
         })  # ← ЗАКРЫВАЮЩАЯ СКОБКА ДЛЯ jsonify() И ЗАПЯТАЯ
 
-    except Exception as e:
-        print(f"Ошибка в API order items: {e}")
+    except Exception:
+        logger.exception("Ошибка в API order items")
         return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
+
+
+# Размер страницы истории заказов
+ORDERS_PAGE_SIZE = 10
+
+
+def parse_order_cursor(value):
+    """Разбираем курсор пагинации заказов вида '<дата_создания>_<id>'"""
+    if not value:
+        return None
+    try:
+        created_at, order_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except ValueError:
+        return None
+
+
+def make_order_cursor(order):
+    """Курсор пагинации для строки заказа (id, ..., дата_создания)"""
+    return f"{order[5].isoformat()}_{order[0]}"
+
+
 # Страница "Мои заказы"
 @app.route('/my_orders')
 def my_orders():
@@ -868,50 +1331,73 @@ def my_orders():
         conn = get_db_connection()
         cur = conn.cursor()
 
-        # Получаем заказы пользователя
-        cur.execute('''
-            SELECT 
-                o.id,
-                o.номер_заказа,
-                o.статус,
-                o.общая_сумма,
-                o.адрес_доставки,
-                o.дата_создания
-            FROM "order" o
-            WHERE o.пользователь_id = %s 
-            ORDER BY o.дата_создания DESC;
-        ''', (user_id,))
+        # Keyset-пагинация по (дата_создания, id): before - более старые заказы, after - более новые
+        before = parse_order_cursor(request.args.get('before'))
+        after = parse_order_cursor(request.args.get('after')) if not before else None
+
+        if before:
+            cur.execute('''
+                SELECT o.id, o.номер_заказа, o.статус, o.общая_сумма, o.адрес_доставки, o.дата_создания
+                FROM "order" o
+                WHERE o.пользователь_id = %s AND (o.дата_создания, o.id) < (%s, %s)
+                ORDER BY o.дата_создания DESC, o.id DESC
+                LIMIT %s;
+            ''', (user_id, before[0], before[1], ORDERS_PAGE_SIZE + 1))
+        elif after:
+            cur.execute('''
+                SELECT o.id, o.номер_заказа, o.статус, o.общая_сумма, o.адрес_доставки, o.дата_создания
+                FROM "order" o
+                WHERE o.пользователь_id = %s AND (o.дата_создания, o.id) > (%s, %s)
+                ORDER BY o.дата_создания ASC, o.id ASC
+                LIMIT %s;
+            ''', (user_id, after[0], after[1], ORDERS_PAGE_SIZE + 1))
+        else:
+            cur.execute('''
+                SELECT o.id, o.номер_заказа, o.статус, o.общая_сумма, o.адрес_доставки, o.дата_создания
+                FROM "order" o
+                WHERE o.пользователь_id = %s
+                ORDER BY o.дата_создания DESC, o.id DESC
+                LIMIT %s;
+            ''', (user_id, ORDERS_PAGE_SIZE + 1))
 
         orders_data = cur.fetchall()
 
-        # Для каждого заказа получаем его товары
+        # Лишняя строка говорит о том, что в этом направлении есть еще страница
+        has_more = len(orders_data) > ORDERS_PAGE_SIZE
+        orders_data = orders_data[:ORDERS_PAGE_SIZE]
+        if after:
+            orders_data.reverse()
+
+        next_cursor = None
+        prev_cursor = None
+        if orders_data:
+            if has_more or after:
+                next_cursor = make_order_cursor(orders_data[-1])
+            if (after and has_more) or before:
+                prev_cursor = make_order_cursor(orders_data[0])
+
+        # Товары всех заказов страницы одним запросом
+        items_by_order = {}
+        if orders_data:
+            cur.execute('''
+                SELECT 
+                    oi.order_id,
+                    p.название AS product_name,
+                    oi.quantity,
+                    oi.price_at_order,
+                    (oi.quantity * oi.price_at_order) as total,
+                    p.изображение
+                FROM order_items oi
+                LEFT JOIN product p ON oi.product_id = p.id
+                WHERE oi.order_id = ANY(%s)
+                ORDER BY oi.order_id, oi.id;
+            ''', ([order[0] for order in orders_data],))
+
+            for row in cur.fetchall():
+                items_by_order.setdefault(row[0], []).append(row[1:])
+
         orders_with_items = []
         for order in orders_data:
-            order_id = order[0]
-
-            try:
-                # Получаем товары этого заказа
-                cur.execute('''
-                    SELECT 
-                        p.название AS product_name,
-                        oi.quantity,
-                        oi.price_at_order,
-                        (oi.quantity * oi.price_at_order) as total,
-                        p.изображение
-                    FROM order_items oi
-                    LEFT JOIN product p ON oi.product_id = p.id
-                    WHERE oi.order_id = %s
-                    ORDER BY oi.id;
-                ''', (order_id,))
-
-                items = cur.fetchall()
-            except Exception as e:
-                # Если таблицы order_items нет или другая ошибка
-                print(f"Ошибка при получении товаров для заказа {order_id}: {e}")
-                items = []
-
-            # Создаем словарь с заказом и его товарами
-  
             order_dict = {
                 'id': order[0],
                 'number': order[1],
@@ -919,25 +1405,34 @@ def my_orders():
                 'total': float(order[3]) if order[3] else 0.0,
                 'address': order[4] if order[4] else 'Адрес не указан',
                 'date': order[5],
-                'order_items': items  # Изменено с 'items' на 'order_items'
+                'order_items': items_by_order.get(order[0], [])
             }
             orders_with_items.append(order_dict)
 
-        cur.close()
-        conn.close()
+        # Общая статистика по всем заказам пользователя нужна только на первой
+        # странице: при листании курсором она не пересчитывается
+        totals = {}
+        if not before and not after:
+            cur.execute('''
+                SELECT COUNT(*), COALESCE(SUM(общая_сумма), 0)
+                FROM "order"
+                WHERE пользователь_id = %s;
+            ''', (user_id,))
+            orders_count, orders_total = cur.fetchone()
+            totals = {'orders_count': orders_count, 'orders_total': float(orders_total)}
 
-        print(f"=== ОТЛАДКА MY_ORDERS ===")
-        print(f"Заказов найдено: {len(orders_with_items)}")
+        cur.close()
 
-        total_sum = sum(order['total'] for order in orders_with_items)
-        print(f"Общая сумма всех заказов: {total_sum}")
+        logger.debug("Заказов на странице: %d", len(orders_with_items))
 
-        return render_template('my_orders.html', orders=orders_with_items)
+        return render_template('my_orders.html',
+                               orders=orders_with_items,
+                               next_cursor=next_cursor,
+                               prev_cursor=prev_cursor,
+                               **totals)
 
-    except Exception as e:
-        print(f"Ошибка при загрузке заказов: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Ошибка при загрузке заказов")
         flash('Ошибка при загрузке заказов', 'error')
         return render_template('my_orders.html', orders=[])
 # Функция для получения деталей заказа с товарами
@@ -977,12 +1472,11 @@ def get_order_details(order_id):
         items = cur.fetchall()
 
         cur.close()
-        conn.close()
 
         return order, items
 
-    except Exception as e:
-        print(f"Ошибка при получении деталей заказа: {e}")
+    except Exception:
+        logger.exception("Ошибка при получении деталей заказа")
         return None, []
 
 # Детали заказа
@@ -998,38 +1492,17 @@ def order_details(order_id):
 
         connection = get_db_connection()
 
-        cursor = connection.cursor()
-
         # Проверяем что заказ принадлежит пользователю
-        cursor.execute('''
-            SELECT 
-                o.id,
-                o.номер_заказа,
-                o.статус,
-                o.общая_сумма,
-                o.адрес_доставки,
-                o.дата_создания,
-                p.транзакция_id,
-                p.способ_оплаты,
-                p.дата_оплаты
-            FROM "order" o
-            LEFT JOIN payment p ON o.id = p.заказ_id
-            WHERE o.id = %s AND o.пользователь_id = %s;
-        ''', (order_id, current_user_id))
-
-        order = cursor.fetchone()
+        order = repository.fetch_one(connection, 'user_order', order_id, current_user_id)
 
         if not order:
             flash('Заказ не найден', 'error')
             return redirect(url_for('my_orders'))
 
-        cursor.close()
-        connection.close()
-
         return render_template('order_details.html', order=order)
 
-    except Exception as error:  # Используем error вместо e
-        print(f"Ошибка при загрузке деталей заказа: {error}")
+    except Exception:
+        logger.exception("Ошибка при загрузке деталей заказа")
         flash('Ошибка при загрузке деталей заказа', 'error')
         return redirect(url_for('my_orders'))
 
@@ -1047,12 +1520,7 @@ def payment(order_id):
         cur = conn.cursor()
 
         # Проверяем, что заказ принадлежит пользователю
-        cur.execute('''
-            SELECT id, номер_заказа, общая_сумма, статус 
-            FROM "order" 
-            WHERE id = %s AND пользователь_id = %s;
-        ''', (order_id, user_id))
-        order = cur.fetchone()
+        order = repository.fetch_one(conn, 'user_order', order_id, user_id)
 
         if not order:
             flash('Заказ не найден', 'error')
@@ -1066,28 +1534,27 @@ def payment(order_id):
                 flash('Выберите способ оплаты', 'error')
                 return redirect(url_for('payment', order_id=order_id))
 
-            # Находим максимальный ID для платежа
-            cur.execute('SELECT COALESCE(MAX(id), 0) FROM payment;')
-            max_payment_id = cur.fetchone()[0]
-            new_payment_id = max_payment_id + 1
-
             # Создаем транзакцию
             transaction_id = f"TXN-{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
             # Создаем запись о платеже
             cur.execute('''
-                INSERT INTO payment (id, заказ_id, способ_оплаты, статус, сумма, дата_оплаты, транзакция_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ''', (new_payment_id, order_id, payment_method, 'успешно', order[2], datetime.now(), transaction_id))
+                INSERT INTO payment (заказ_id, способ_оплаты, статус, сумма, дата_оплаты, транзакция_id)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', (order_id, payment_method, 'успешно', order.total, datetime.now(), transaction_id))
 
-            # Обновляем статус заказа
+            # Обновляем статус заказа, в статистику попадает только первая оплата
             cur.execute('''
-                UPDATE "order" SET статус = 'оплачен' WHERE id = %s;
+                UPDATE "order" SET статус = 'оплачен'
+                WHERE id = %s AND статус IS DISTINCT FROM 'оплачен'
+                RETURNING общая_сумма;
             ''', (order_id,))
+            paid = cur.fetchone()
+            if paid:
+                sales_stats.record_payment(cur, paid[0])
 
             conn.commit()
             cur.close()
-            conn.close()
 
             flash('Оплата прошла успешно! Спасибо за покупку!', 'success')
             return redirect(url_for('order_success', order_id=order_id))
@@ -1095,12 +1562,10 @@ def payment(order_id):
         else:
             # GET запрос - показываем страницу оплаты
             cur.close()
-            conn.close()
             return render_template('payment.html', order=order)
 
-    except Exception as e:
-        print(f"Ошибка при обработке оплаты: {e}")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("Ошибка при обработке оплаты")
         flash('Ошибка при обработке оплаты', 'error')
         return redirect(url_for('index'))
 
@@ -1114,35 +1579,17 @@ def order_success(order_id):
         return redirect(url_for('login'))
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         # Получаем информацию о заказе и платеже
-        cur.execute('''
-            SELECT 
-                o.номер_заказа,
-                o.общая_сумма,
-                o.адрес_доставки,
-                o.дата_создания,
-                p.транзакция_id,
-                p.дата_оплаты
-            FROM "order" o
-            LEFT JOIN payment p ON o.id = p.заказ_id
-            WHERE o.id = %s AND o.пользователь_id = %s;
-        ''', (order_id, user_id))
-        order_info = cur.fetchone()
+        order_info = repository.fetch_one(get_db_connection(), 'user_order', order_id, user_id)
 
         if not order_info:
             flash('Заказ не найден', 'error')
             return redirect(url_for('index'))
 
-        cur.close()
-        conn.close()
-
         return render_template('order_success.html', order=order_info)
 
-    except Exception as e:
-        print(f"Ошибка при загрузке страницы успеха: {e}")
+    except Exception:
+        logger.exception("Ошибка при загрузке страницы успеха")
         flash('Ошибка при загрузке информации о заказе', 'error')
         return redirect(url_for('index'))
 
@@ -1151,32 +1598,43 @@ def admin_stats():
     conn = get_db_connection()
     cur = conn.cursor()
 
-    #  Оконный запрос 1 — рейтинг товаров по продажам
+    # Рейтинг товаров по продажам: агрегаты из миграции sales_stats, строк не больше, чем товаров
     cur.execute('''
         SELECT 
             p.название AS product_name,
-            SUM(oi.quantity) AS sold,
-            RANK() OVER (ORDER BY SUM(oi.quantity) DESC) AS sales_rank
-        FROM order_items oi
-        JOIN product p ON oi.product_id = p.id
-        GROUP BY p.id, p.название
+            s.units AS sold,
+            RANK() OVER (ORDER BY s.units DESC) AS sales_rank,
+            s.revenue,
+            s.orders_count
+        FROM product_sales s
+        JOIN product p ON s.product_id = p.id
+        WHERE s.units > 0
         ORDER BY sales_rank;
     ''')
     product_stats = cur.fetchall()
 
-    # Оконный запрос 2 — средний чек по заказам
+    # Общая статистика заказов: итоги последней сверки плюс дельты после нее
     cur.execute('''
         SELECT 
-            id,
-            номер_заказа,
-            общая_сумма,
-            AVG(общая_сумма) OVER () AS avg_order_amount
-        FROM "order";
+            t.orders_count + d.orders_count,
+            t.orders_total + d.orders_total,
+            CASE WHEN t.orders_count + d.orders_count > 0
+                 THEN (t.orders_total + d.orders_total) / (t.orders_count + d.orders_count) END AS avg_order_amount,
+            t.paid_count + d.paid_count,
+            t.paid_total + d.paid_total,
+            t.reconciled_at
+        FROM sales_totals t
+        CROSS JOIN (
+            SELECT COALESCE(SUM(orders_count), 0) AS orders_count,
+                   COALESCE(SUM(orders_total), 0) AS orders_total,
+                   COALESCE(SUM(paid_count), 0) AS paid_count,
+                   COALESCE(SUM(paid_total), 0) AS paid_total
+            FROM sales_totals_delta
+        ) d;
     ''')
-    order_stats = cur.fetchall()
+    order_stats = cur.fetchone()
 
     cur.close()
-    conn.close()
 
     return render_template(
         'admin_stats.html',
@@ -1185,6 +1643,73 @@ def admin_stats():
     )
 
 
+# Токен служебных эндпоинтов: метрики, SQL-запросы с параметрами и планами,
+# статистика пулов и кэшей. Без ADMIN_TOKEN эти эндпоинты выключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+
+def admin_token_required(view):
+    """Пускаем только запросы с заголовком Authorization: Bearer <ADMIN_TOKEN>"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        authorization = request.headers.get('Authorization', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(authorization.encode(),
+                                                      f'Bearer {ADMIN_TOKEN}'.encode()):
+            response = jsonify({'error': 'Требуется токен администратора'})
+            response.status_code = 401
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route('/metrics')
+@admin_token_required
+def metrics_endpoint():
+    """Метрики всех воркеров в формате Prometheus"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/slow_queries')
+@admin_token_required
+def slow_queries():
+    """Самые дорогие SQL-запросы текущего воркера"""
+    return jsonify(query_tracer.top(request.args.get('limit', 20, type=int)))
+
+
+@app.route('/admin/auth_stats')
+@admin_token_required
+def auth_stats():
+    """Пул хэширования паролей и ограничители входа текущего воркера"""
+    return jsonify({
+        'password_hasher': password_hasher.stats(),
+        'ip_limiter': auth_ip_limiter.stats(),
+        'email_limiter': auth_email_limiter.stats()
+    })
+
+
+@app.route('/admin/db_pool')
+@admin_token_required
+def db_pool_stats():
+    """Статистика пула соединений текущего воркера"""
+    return jsonify(db_pool.stats())
+
+
+@app.route('/admin/cache_stats')
+@admin_token_required
+def cache_stats():
+    """Статистика кэшей текущего воркера"""
+    return jsonify({
+        'catalog': catalog_cache.stats(),
+        'listings': listing_cache.stats(),
+        'search': search_cache.stats(),
+        'pages': page_cache.stats(),
+        'users': user_cache.stats(),
+        'reports': report_cache.stats()
+    })
+
+
 # Добавьте в app.py после существующих маршрутов, но перед if __name__ == '__main__':
 
 @app.route('/sql_queries')
@@ -1212,233 +1737,367 @@ def sql_queries():
         users = cur.fetchall()
 
         cur.close()
-        conn.close()
 
         return render_template('sql_queries.html',
                                categories=categories,
                                statuses=statuses,
                                users=users)
 
-    except Exception as e:
-        print(f"Ошибка при загрузке страницы SQL запросов: {e}")
+    except Exception:
+        logger.exception("Ошибка при загрузке страницы SQL запросов")
         flash('Ошибка при загрузке страницы', 'error')
         return redirect(url_for('index'))
 
 
-@app.route('/execute_query/<int:query_id>', methods=['GET', 'POST'])
-def execute_query(query_id):
-    """Выполнение конкретного SQL запроса"""
-    user_id = get_current_user_id()
-    if not user_id:
-        return jsonify({'error': 'Требуется авторизация'}), 401
+# Кэширование отчетов: id -> (срок жизни в секундах, таблицы, запись в которые сбрасывает отчет)
+REPORT_CACHE_POLICY = {
+    1: (600, ('order_items', 'product')),
+    2: (600, ('review', 'product')),
+    3: (300, ('order', 'user')),
+    4: (600, ('order_items', 'product', 'category')),
+    5: (120, ('order',)),
+    6: (1800, ('product', 'category')),
+    7: (1800, ('product',)),
+    8: (120, ('order', 'user')),
+    9: (120, ('order', 'order_items')),
+    10: (600, ('review', 'product', 'user')),
+}
 
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
 
-        results = []
-        columns = []
+def report_query(query_id, user_id):
+    """SQL и параметры запроса со страницы /sql_queries или None для неизвестного id.
 
-        if query_id == 1:
-            # Запрос 1: Статический - Топ товаров по продажам
-            sql = '''
-            SELECT 
-                p.название AS "Название товара",
-                SUM(oi.quantity) AS "Продано, шт.",
-                RANK() OVER (ORDER BY SUM(oi.quantity) DESC) AS "Ранг"
-            FROM order_items oi
-            JOIN product p ON oi.product_id = p.id
-            WHERE p.активен = True
-            GROUP BY p.id, p.название
-            ORDER BY "Продано, шт." DESC
-            LIMIT 10;
-            '''
-
-        elif query_id == 2:
-            # Запрос 2: Статический - Средняя оценка товаров
-            sql = '''
-            SELECT 
-                p.название AS "Товар",
-                ROUND(AVG(r.рейтинг), 2) AS "Средний рейтинг",
-                COUNT(r.id) AS "Количество отзывов"
-            FROM review r
-            JOIN product p ON r.товар_id = p.id
-            WHERE r.одобрен = True
-            GROUP BY p.id, p.название
-            HAVING COUNT(r.id) >= 2
-            ORDER BY "Средний рейтинг" DESC;
-            '''
-
-        elif query_id == 3:
-            # Запрос 3: Статический - Пользователи с наибольшим количеством заказов
-            sql = '''
-            SELECT 
-                u.имя || ' ' || u.фамилия AS "Покупатель",
-                COUNT(o.id) AS "Количество заказов",
-                SUM(o.общая_сумма) AS "Общая сумма покупок"
-            FROM "order" o
-            JOIN "user" u ON o.пользователь_id = u.id
-            GROUP BY u.id, u.имя, u.фамилия
-            ORDER BY "Количество заказов" DESC
-            LIMIT 8;
-            '''
-
-        elif query_id == 4:
-            # Запрос 4: С оконной функцией - Рейтинг товаров в каждой категории
-            sql = '''
-            SELECT 
-                c.название AS "Категория",
-                p.название AS "Товар",
-                SUM(oi.quantity) AS "Продано, шт.",
-                RANK() OVER (PARTITION BY c.id ORDER BY SUM(oi.quantity) DESC) AS "Ранг в категории"
-            FROM order_items oi
-            JOIN product p ON oi.product_id = p.id
-            JOIN category c ON p.категория_id = c.id
-            WHERE p.активен = True
-            GROUP BY c.id, c.название, p.id, p.название
-            ORDER BY c.название, "Продано, шт." DESC;
-            '''
-
-        elif query_id == 5:
-            # Запрос 5: С оконной функцией - Сравнение с средним чеком
-            sql = '''
-            SELECT 
-                o.номер_заказа AS "Номер заказа",
-                o.общая_сумма AS "Сумма заказа",
-                ROUND(AVG(o.общая_сумма) OVER (), 2) AS "Средний чек",
-                o.общая_сумма - ROUND(AVG(o.общая_сумма) OVER (), 2) AS "Отклонение от среднего"
-            FROM "order" o
-            ORDER BY o.общая_сумма DESC;
-            '''
+    Параметры приводятся к типам, чтобы по ним можно было кэшировать результат.
+    """
+    params = ()
+
+    if query_id == 1:
+        # Запрос 1: Статический - Топ товаров по продажам
+        sql = '''
+        SELECT 
+            p.название AS "Название товара",
+            SUM(oi.quantity) AS "Продано, шт.",
+            RANK() OVER (ORDER BY SUM(oi.quantity) DESC) AS "Ранг"
+        FROM order_items oi
+        JOIN product p ON oi.product_id = p.id
+        WHERE p.активен = True
+        GROUP BY p.id, p.название
+        ORDER BY "Продано, шт." DESC
+        LIMIT 10;
+        '''
 
-        elif query_id == 6:
-            # Запрос 6: Параметризованный - Товары в указанном ценовом диапазоне
-            min_price = request.args.get('min_price', 0)
-            max_price = request.args.get('max_price', 10000)
+    elif query_id == 2:
+        # Запрос 2: Статический - Средняя оценка товаров
+        sql = '''
+        SELECT 
+            p.название AS "Товар",
+            ROUND(AVG(r.рейтинг), 2) AS "Средний рейтинг",
+            COUNT(r.id) AS "Количество отзывов"
+        FROM review r
+        JOIN product p ON r.товар_id = p.id
+        WHERE r.одобрен = True
+        GROUP BY p.id, p.название
+        HAVING COUNT(r.id) >= 2
+        ORDER BY "Средний рейтинг" DESC;
+        '''
 
-            sql = '''
-            SELECT 
-                p.название AS "Название товара",
-                p.цена AS "Цена",
-                c.название AS "Категория",
-                p.цвет AS "Цвет"
-            FROM product p
-            JOIN category c ON p.категория_id = c.id
-            WHERE p.активен = True 
-                AND p.цена BETWEEN %s AND %s
-            ORDER BY p.цена DESC;
-            '''
-            cur.execute(sql, (min_price, max_price))
+    elif query_id == 3:
+        # Запрос 3: Статический - Пользователи с наибольшим количеством заказов
+        sql = '''
+        SELECT 
+            u.имя || ' ' || u.фамилия AS "Покупатель",
+            COUNT(o.id) AS "Количество заказов",
+            SUM(o.общая_сумма) AS "Общая сумма покупок"
+        FROM "order" o
+        JOIN "user" u ON o.пользователь_id = u.id
+        GROUP BY u.id, u.имя, u.фамилия
+        ORDER BY "Количество заказов" DESC
+        LIMIT 8;
+        '''
+
+    elif query_id == 4:
+        # Запрос 4: С оконной функцией - Рейтинг товаров в каждой категории
+        sql = '''
+        SELECT 
+            c.название AS "Категория",
+            p.название AS "Товар",
+            SUM(oi.quantity) AS "Продано, шт.",
+            RANK() OVER (PARTITION BY c.id ORDER BY SUM(oi.quantity) DESC) AS "Ранг в категории"
+        FROM order_items oi
+        JOIN product p ON oi.product_id = p.id
+        JOIN category c ON p.категория_id = c.id
+        WHERE p.активен = True
+        GROUP BY c.id, c.название, p.id, p.название
+        ORDER BY c.название, "Продано, шт." DESC;
+        '''
+
+    elif query_id == 5:
+        # Запрос 5: С оконной функцией - Сравнение с средним чеком
+        sql = '''
+        SELECT 
+            o.номер_заказа AS "Номер заказа",
+            o.общая_сумма AS "Сумма заказа",
+            ROUND(AVG(o.общая_сумма) OVER (), 2) AS "Средний чек",
+            o.общая_сумма - ROUND(AVG(o.общая_сумма) OVER (), 2) AS "Отклонение от среднего"
+        FROM "order" o
+        ORDER BY o.общая_сумма DESC;
+        '''
+
+    elif query_id == 6:
+        # Запрос 6: Параметризованный - Товары в указанном ценовом диапазоне
+        min_price = request.args.get('min_price', 0.0, type=float)
+        max_price = request.args.get('max_price', 10000.0, type=float)
+
+        sql = '''
+        SELECT 
+            p.название AS "Название товара",
+            p.цена AS "Цена",
+            c.название AS "Категория",
+            p.цвет AS "Цвет"
+        FROM product p
+        JOIN category c ON p.категория_id = c.id
+        WHERE p.активен = True 
+            AND p.цена BETWEEN %s AND %s
+        ORDER BY p.цена DESC;
+        '''
+        params = (min_price, max_price)
+
+    elif query_id == 7:
+        # Запрос 7: Параметризованный - Товары выбранной категории
+        category_id = request.args.get('category_id', 1, type=int)
+
+        sql = '''
+        SELECT 
+            p.название AS "Название товара",
+            p.цена AS "Цена",
+            p.цвет AS "Цвет",
+            p.размер AS "Размер"
+        FROM product p
+        WHERE p.активен = True 
+            AND p.категория_id = %s
+        ORDER BY p.название;
+        '''
+        params = (category_id,)
+
+    elif query_id == 8:
+        # Запрос 8: Параметризованный - Заказы по статусу
+        status = request.args.get('status', 'создан').strip()
+
+        sql = '''
+        SELECT 
+            o.номер_заказа AS "Номер заказа",
+            u.имя || ' ' || u.фамилия AS "Покупатель",
+            o.общая_сумма AS "Сумма",
+            o.статус AS "Статус",
+            o.дата_создания AS "Дата создания"
+        FROM "order" o
+        JOIN "user" u ON o.пользователь_id = u.id
+        WHERE o.статус = %s
+        ORDER BY o.дата_создания DESC;
+        '''
+        params = (status,)
+
+    elif query_id == 9:
+        # Запрос 9: Параметризованный - Заказы конкретного пользователя
+        user_id_param = request.args.get('user_id', user_id, type=int)
+
+        sql = '''
+        SELECT 
+            o.номер_заказа AS "Номер заказа",
+            o.общая_сумма AS "Сумма заказа",
+            o.статус AS "Статус",
+            o.дата_создания AS "Дата",
+            COUNT(oi.product_id) AS "Количество товаров"
+        FROM "order" o
+        JOIN order_items oi ON o.id = oi.order_id
+        WHERE o.пользователь_id = %s
+        GROUP BY o.id, o.номер_заказа, o.общая_сумма, o.статус, o.дата_создания
+        ORDER BY o.дата_создания DESC;
+        '''
+        params = (user_id_param,)
+
+    elif query_id == 10:
+        # Запрос 10: Параметризованный - Отзывы с минимальным рейтингом
+        min_rating = request.args.get('min_rating', 4, type=int)
+
+        sql = '''
+        SELECT 
+            p.название AS "Товар",
+            u.имя || ' ' || u.фамилия AS "Автор отзыва",
+            r.рейтинг AS "Оценка",
+            r.комментарий AS "Комментарий",
+            r.дата_создания AS "Дата"
+        FROM review r
+        JOIN product p ON r.товар_id = p.id
+        JOIN "user" u ON r.пользователь_id = u.id
+        WHERE r.одобрен = True 
+            AND r.рейтинг >= %s
+        ORDER BY r.рейтинг DESC, r.дата_создания DESC;
+        '''
+        params = (min_rating,)
+
+    else:
+        return None
 
-        elif query_id == 7:
-            # Запрос 7: Параметризованный - Товары выбранной категории
-            category_id = request.args.get('category_id', 1)
+    return sql, params
 
-            sql = '''
-            SELECT 
-                p.название AS "Название товара",
-                p.цена AS "Цена",
-                p.цвет AS "Цвет",
-                p.размер AS "Размер"
-            FROM product p
-            WHERE p.активен = True 
-                AND p.категория_id = %s
-            ORDER BY p.название;
-            '''
-            cur.execute(sql, (category_id,))
 
-        elif query_id == 8:
-            # Запрос 8: Параметризованный - Заказы по статусу
-            status = request.args.get('status', 'создан')
+QUERY_STREAM_ITERSIZE = int(os.getenv('QUERY_STREAM_ITERSIZE', 2000))
+QUERY_STREAM_CHUNK = 16384
+QUERY_EXPORT_FORMATS = ('html', 'csv', 'ndjson')
 
-            sql = '''
-            SELECT 
-                o.номер_заказа AS "Номер заказа",
-                u.имя || ' ' || u.фамилия AS "Покупатель",
-                o.общая_сумма AS "Сумма",
-                o.статус AS "Статус",
-                o.дата_создания AS "Дата создания"
-            FROM "order" o
-            JOIN "user" u ON o.пользователь_id = u.id
-            WHERE o.статус = %s
-            ORDER BY o.дата_создания DESC;
-            '''
-            cur.execute(sql, (status,))
 
-        elif query_id == 9:
-            # Запрос 9: Параметризованный - Заказы конкретного пользователя
-            user_id_param = request.args.get('user_id', user_id)
+def load_report(sql, params):
+    """Фоновое обновление отчета в кэше: (столбцы, строки) или None, если строк слишком много"""
+    conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchmany(REPORT_CACHE_MAX_ROWS + 1)
+        columns = [desc[0] for desc in cur.description]
+        cur.close()
+        conn.rollback()
+    finally:
+        db_pool.putconn(conn)
+    if len(rows) > REPORT_CACHE_MAX_ROWS:
+        return None
+    return columns, tuple(rows)
+
+
+def buffered(parts, size=QUERY_STREAM_CHUNK):
+    """Склеиваем мелкие куски потокового ответа, чтобы не писать в сокет на каждую строку"""
+    buffer = []
+    buffered_size = 0
+    for part in parts:
+        buffer.append(part)
+        buffered_size += len(part)
+        if buffered_size >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered_size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def csv_lines(columns, rows):
+    """Строки CSV по одной (с BOM, чтобы Excel понял UTF-8)"""
+    line = io.StringIO()
+    writer = csv.writer(line)
+    yield '\ufeff'
+    for row in itertools.chain([columns], rows):
+        writer.writerow(row)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+
+
+def ndjson_lines(columns, rows):
+    """Одна строка результата - один JSON-объект"""
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n'
 
-            sql = '''
-            SELECT 
-                o.номер_заказа AS "Номер заказа",
-                o.общая_сумма AS "Сумма заказа",
-                o.статус AS "Статус",
-                o.дата_создания AS "Дата",
-                COUNT(oi.product_id) AS "Количество товаров"
-            FROM "order" o
-            JOIN order_items oi ON o.id = oi.order_id
-            WHERE o.пользователь_id = %s
-            GROUP BY o.id, o.номер_заказа, o.общая_сумма, o.статус, o.дата_создания
-            ORDER BY o.дата_создания DESC;
-            '''
-            cur.execute(sql, (user_id_param,))
-
-        elif query_id == 10:
-            # Запрос 10: Параметризованный - Отзывы с минимальным рейтингом
-            min_rating = request.args.get('min_rating', 4)
-
-            sql = '''
-            SELECT 
-                p.название AS "Товар",
-                u.имя || ' ' || u.фамилия AS "Автор отзыва",
-                r.рейтинг AS "Оценка",
-                r.комментарий AS "Комментарий",
-                r.дата_создания AS "Дата"
-            FROM review r
-            JOIN product p ON r.товар_id = p.id
-            JOIN "user" u ON r.пользователь_id = u.id
-            WHERE r.одобрен = True 
-                AND r.рейтинг >= %s
-            ORDER BY r.рейтинг DESC, r.дата_создания DESC;
-            '''
-            cur.execute(sql, (min_rating,))
 
-        else:
-            cur.close()
-            conn.close()
-            return jsonify({'error': 'Неверный ID запроса'}), 400
+@app.route('/execute_query/<int:query_id>', methods=['GET', 'POST'])
+def execute_query(query_id):
+    """Выполнение конкретного SQL запроса.
 
-        # Выполняем запросы 1-5 (без параметров)
-        if query_id <= 5:
-            cur.execute(sql)
+    Результат читается серверным курсором порциями по QUERY_STREAM_ITERSIZE
+    строк и отдается потоком: HTML-страницей или, с ?format=csv|ndjson, файлом.
+    """
+    user_id = get_current_user_id()
+    if not user_id:
+        return jsonify({'error': 'Требуется авторизация'}), 401
 
-        # Получаем результаты
-        if cur.description:
+    export_format = request.args.get('format', 'html')
+    if export_format not in QUERY_EXPORT_FORMATS:
+        return jsonify({'error': 'Неверный формат'}), 400
+
+    query = report_query(query_id, user_id)
+    if query is None:
+        return jsonify({'error': 'Неверный ID запроса'}), 400
+    sql, params = query
+
+    # Устаревший результат отдается сразу, а обновляется в фоне
+    cache_key = (query_id, params)
+    cached = report_cache.get(cache_key, refresh=lambda: load_report(sql, params))
+    cur = None
+    # Соединение для серверного курсора берется не через get_db_connection():
+    # teardown_appcontext возвращает соединение запроса в пул раньше, чем
+    # прочитано тело потокового ответа, а откат закрыл бы курсор на середине.
+    # Это соединение принадлежит ответу и возвращается, когда поток дочитан
+    # или закрыт
+    conn = None
+
+    def release():
+        nonlocal conn
+        if conn is not None:
+            # putconn откатывает транзакцию, вместе с ней закрывается и курсор
+            db_pool.putconn(conn)
+            conn = None
+
+    if cached is not None:
+        columns, first_rows = cached
+    else:
+        # Если отчет сбросят, пока идет запрос, прочитанный результат уже устарел
+        generation = report_cache.generation()
+        try:
+            conn = db_pool.getconn()
+            # Именованный курсор: строки остаются на сервере и приходят порциями
+            cur = conn.cursor(name=f'report_{query_id}')
+            cur.itersize = QUERY_STREAM_ITERSIZE
+            cur.execute(sql, params)
+            # Первая порция читается до начала ответа, чтобы ошибка запроса попала на страницу ошибки
+            first_rows = cur.fetchmany(QUERY_STREAM_ITERSIZE)
             columns = [desc[0] for desc in cur.description]
-            results = cur.fetchall()
+            if len(first_rows) < QUERY_STREAM_ITERSIZE:
+                # Результат уже прочитан целиком, курсор и соединение больше не нужны
+                cur.close()
+                release()
+                if len(first_rows) <= REPORT_CACHE_MAX_ROWS:
+                    report_cache.set(cache_key, (columns, tuple(first_rows)), REPORT_CACHE_POLICY[query_id][0],
+                                     generation=generation)
+        except Exception as e:
+            logger.exception("Ошибка выполнения запроса %s", query_id)
+            release()
+            return render_template('query_results.html',
+                                   query_id=query_id,
+                                   error=str(e))
+
+    def rows():
+        try:
+            yield from first_rows
+            if conn is not None:
+                yield from cur
+        except Exception:
+            # Статус уже отправлен: обрываем ответ, чтобы обрезанный результат
+            # не выглядел полным
+            logger.exception("Ошибка чтения результата запроса %s", query_id)
+            raise
+        finally:
+            release()
+
+    if export_format == 'csv':
+        response = Response(stream_with_context(buffered(csv_lines(columns, rows()))),
+                            mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename=query_{query_id}.csv'
+    elif export_format == 'ndjson':
+        response = Response(stream_with_context(buffered(ndjson_lines(columns, rows()))),
+                            mimetype='application/x-ndjson')
+    else:
+        export_args = {key: value for key, value in request.args.items() if key != 'format'}
+        response = Response(buffered(stream_template('query_results.html',
+                                                     query_id=query_id,
+                                                     columns=columns,
+                                                     rows=rows(),
+                                                     has_rows=bool(first_rows),
+                                                     export_args=export_args)),
+                            mimetype='text/html')
+    # Если клиент ушел до начала чтения, генератор не запустится и finally не сработает
+    response.call_on_close(release)
+    return response
+
 
-        cur.close()
-        conn.close()
-
-        # Преобразуем результаты в список словарей для удобства
-        results_list = []
-        for row in results:
-            row_dict = {}
-            for i, col in enumerate(columns):
-                row_dict[col] = row[i]
-            results_list.append(row_dict)
-
-        return render_template('query_results.html',
-                               query_id=query_id,
-                               columns=columns,
-                               results=results_list,
-                               row_count=len(results_list))
-
-    except Exception as e:
-        print(f"Ошибка выполнения запроса {query_id}: {e}")
-        return render_template('query_results.html',
-                               query_id=query_id,
-                               error=str(e))
 if __name__ == '__main__':
+    if os.getenv('SCHEMA_CHECK', '1') != '0':
+        check_schema()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""Сборка статики: файлы с хэшем содержимого в имени и сжатые варианты.
+
+Сборка (перед запуском приложения):
+    python assets.py
+
+Для каждого файла из ASSET_PATTERNS в static/build/ кладется копия
+с хэшем в имени (style.css -> build/style.3f2a1b9c0d.css), для текстовых
+файлов еще .gz и, если установлен пакет brotli, .br. Для картинок товаров
+дополнительно генерируются уменьшенные копии по ширинам из IMAGE_WIDTHS
+(нужен Pillow). Соответствие исходных имен собранным записывается
+в static/build/manifest.json.
+"""
+import glob
+import gzip
+import hashlib
+import importlib.util
+import json
+import logging
+import mimetypes
+import os
+import shutil
+from datetime import datetime, timezone
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен, тогда собираем только gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = 'build'
+MANIFEST_NAME = 'manifest.json'
+
+# Что собираем (относительно static/)
+ASSET_PATTERNS = ('*.css', 'images/**/*.*')
+
+# Эти типы сжимаем заранее, картинки уже сжаты
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.json')
+
+# Варианты сжатия в порядке предпочтения: (Content-Encoding, расширение файла)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Ширины уменьшенных копий картинок: миниатюра, карточка каталога, страница товара
+IMAGE_WIDTHS = {'thumb': 240, 'card': 480, 'detail': 960}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+IMAGE_QUALITY = 80
+
+
+def file_hash(path):
+    """Короткий хэш содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:10]
+
+
+def build_image_variants(path, root, ext, static_dir):
+    """Уменьшенные копии картинки: {'width': исходная ширина, 'variants': [[ширина, путь], ...]}"""
+    from PIL import Image  # нужен только при сборке
+
+    with Image.open(path) as image:
+        original_width = image.width
+        variants = []
+        for width in sorted(IMAGE_WIDTHS.values()):
+            # Не увеличиваем: для узких картинок хватит оригинала
+            if width >= original_width:
+                break
+            height = round(image.height * width / original_width)
+            resized = image.resize((width, height), Image.LANCZOS)
+            if ext.lower() in ('.jpg', '.jpeg') and resized.mode != 'RGB':
+                resized = resized.convert('RGB')
+
+            tmp_path = os.path.join(static_dir, BUILD_DIR, f'{root}.{width}w.tmp{ext}')
+            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+            resized.save(tmp_path, quality=IMAGE_QUALITY)
+            hashed = f'{BUILD_DIR}/{root}.{width}w.{file_hash(tmp_path)}{ext}'
+            os.replace(tmp_path, os.path.join(static_dir, hashed))
+            variants.append([width, hashed])
+    return {'width': original_width, 'variants': variants}
+
+
+def build(static_dir=STATIC_DIR):
+    """Собираем статику в static/build и пишем манифест"""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    manifest = {'files': {}, 'images': {}}
+    resize_images = importlib.util.find_spec('PIL') is not None
+    if not resize_images:
+        logger.info("Pillow не установлен, уменьшенные копии картинок не созданы")
+
+    for pattern in ASSET_PATTERNS:
+        for path in sorted(glob.glob(os.path.join(static_dir, pattern), recursive=True)):
+            rel_path = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            if rel_path.startswith(BUILD_DIR + '/') or not os.path.isfile(path):
+                continue
+
+            root, ext = os.path.splitext(rel_path)
+            hashed = f'{BUILD_DIR}/{root}.{file_hash(path)}{ext}'
+            target = os.path.join(static_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+
+            if ext.lower() in COMPRESSIBLE_EXTENSIONS:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as f:
+                        f.write(brotli.compress(data, quality=11))
+
+            manifest['files'][rel_path] = hashed
+            if resize_images and ext.lower() in IMAGE_EXTENSIONS:
+                manifest['images'][rel_path] = build_image_variants(path, root, ext, static_dir)
+
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir=STATIC_DIR):
+    """Манифест собранной статики, без сборки - пустой"""
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest.setdefault('files', {})
+    manifest.setdefault('images', {})
+    return manifest
+
+
+def manifest_version(static_dir=STATIC_DIR):
+    """Хэш и время записи манифеста: (build_id, built_at), без сборки - ('', None)"""
+    path = os.path.join(static_dir, BUILD_DIR, MANIFEST_NAME)
+    try:
+        built_at = datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+        return file_hash(path), built_at
+    except OSError:
+        return '', None
+
+
+def setup_assets(app):
+    """url_for('static', ...) выдает собранные файлы, а они отдаются с вечным кэшем.
+
+    В шаблонах доступна image_srcset(filename) - значение атрибута srcset
+    для картинки (пустая строка, если уменьшенных копий нет).
+    """
+    manifest = load_manifest(app.static_folder)
+    files = manifest['files']
+    images = manifest['images']
+    if not files:
+        logger.info("Манифест статики не найден, файлы отдаются без хэшей (python assets.py)")
+    app.config['ASSET_MANIFEST'] = manifest
+    # Страницы ссылаются на хэшированные имена файлов, поэтому после пересборки
+    # статики их ETag и Last-Modified тоже должны измениться
+    app.config['ASSET_BUILD_ID'], app.config['ASSET_BUILT_AT'] = manifest_version(app.static_folder)
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == 'static':
+            filename = values.get('filename')
+            if filename in files:
+                values['filename'] = files[filename]
+
+    @app.template_global()
+    def image_srcset(filename):
+        image = images.get(filename)
+        if not image or not image['variants']:
+            return ''
+        candidates = [(width, url_for('static', filename=path)) for width, path in image['variants']]
+        candidates.append((image['width'], url_for('static', filename=filename)))
+        return ', '.join(f'{url} {width}w' for width, url in candidates)
+
+    default_static_view = app.view_functions['static']
+
+    def static_view(filename):
+        if not filename.startswith(BUILD_DIR + '/'):
+            return default_static_view(filename=filename)
+
+        # Имя меняется вместе с содержимым, поэтому файл можно кэшировать навсегда
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding in request.accept_encodings and \
+                    os.path.isfile(os.path.join(app.static_folder, filename + suffix)):
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_from_directory(app.static_folder, filename)
+
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.view_functions['static'] = static_view
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    built = build()
+    logger.info("Собрано файлов: %d, картинок с уменьшенными копиями: %d, манифест: %s",
+                len(built['files']), sum(1 for image in built['images'].values() if image['variants']),
+                os.path.join(STATIC_DIR, BUILD_DIR, MANIFEST_NAME))
+    if brotli is None:
+        logger.info("Пакет brotli не установлен, .br варианты не созданы")
@@ -0,0 +1,459 @@
+"""Нагрузочный тест пути покупателя: главная, каталог, товар, корзина, заказ, оплата, мои заказы.
+
+    python bench.py [--url http://127.0.0.1:8000] [--concurrency 8] [--users 16] [--iterations 5]
+                    [--cart-items 2] [--catalog-pages 1] [--products N]
+                    [--output bench_results.json] [--compare файл.json]
+
+Каждый виртуальный пользователь входит под своим аккаунтом
+(bench-<n>@example.com, при первом запуске он регистрируется) и iterations
+раз проходит путь покупателя. Без --url приложение работает в этом же
+процессе через тестовый клиент Flask, без HTTP-сервера, с базой из DB_*.
+С --url нагружается запущенный сервер; лимиты входа у него нужно поднять
+(AUTH_IP_PER_MINUTE), /metrics читается с --admin-token (по умолчанию
+ADMIN_TOKEN из окружения), а при нескольких воркерах нужно задать METRICS_DIR
+и --metrics-wait не меньше METRICS_FLUSH_INTERVAL.
+
+Объем данных: число пользователей, размер корзины и глубина листания
+каталога задаются параметрами, а --products N дополняет каталог товарами
+нагрузки прямо в базе DB_* (только для отдельной тестовой базы). Без
+--products используется каталог, который уже есть в базе.
+
+По каждому шагу считаются p50/p95/p99 времени ответа, запросы в секунду
+и ошибки, число SQL-запросов на HTTP-запрос берется из разницы /metrics
+до и после прогона (по эндпоинту: checkout_form и checkout - один
+эндпоинт). Результат пишется в JSON, --compare печатает сравнение
+с результатом другой ветки.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import re
+import secrets
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+logger = logging.getLogger('bench')
+
+# Шаги пути покупателя в порядке прохождения и их эндпоинты в /metrics
+STEPS = (
+    ('index', 'index'),
+    ('catalog', 'catalog'),
+    ('product_detail', 'product_detail'),
+    ('add_to_cart', 'add_to_cart'),
+    ('view_cart', 'view_cart'),
+    ('checkout_form', 'checkout'),
+    ('checkout', 'checkout'),
+    ('payment_form', 'payment'),
+    ('payment', 'payment'),
+    ('my_orders', 'my_orders'),
+)
+
+PRODUCT_LINK = re.compile(r'/product/(\d+)')
+
+# Картинки для товаров, создаваемых --products
+PRODUCT_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'images', 'products')
+NEXT_PAGE_LINK = re.compile(r'[?&;]after=([^"&]+)')
+PAYMENT_LOCATION = re.compile(r'/payment/(\d+)')
+METRIC_LINE = re.compile(r'^(http_requests_total|db_queries_total)\{(.*)\} (\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+class HttpClient:
+    """Клиент к запущенному серверу: одно keep-alive соединение, свои cookie, редиректы не выполняются"""
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.conn = conn_class(parts.netloc, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={morsel.value}' for name, morsel in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.conn.request(method, self.prefix + path, body, headers)
+            response = self.conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # Сервер закрыл простаивающее соединение, повторяем на новом
+            self.conn.close()
+            self.conn.request(method, self.prefix + path, body, headers)
+            response = self.conn.getresponse()
+        text = response.read().decode('utf-8', 'replace')
+        for header in response.headers.get_all('Set-Cookie') or ():
+            self.cookies.load(header)
+        return response.status, response.headers.get('Location', ''), text
+
+
+class AppClient:
+    """Тестовый клиент Flask: приложение работает в этом же процессе"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None):
+        response = self.client.open(path, method=method, data=data, headers=headers)
+        return response.status_code, response.headers.get('Location', ''), response.get_data(as_text=True)
+
+
+class Recorder:
+    """Время ответа и ошибки по шагам, общие для всех потоков"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def call(self, step, client, method, path, data=None, expect=200):
+        """Выполняем запрос шага; None, если статус не тот, что ожидался"""
+        started = time.perf_counter()
+        try:
+            status, location, body = client.request(method, path, data)
+        except Exception as e:
+            logger.warning("%s %s: %s", method, path, e)
+            status, location, body = None, '', ''
+        elapsed = time.perf_counter() - started
+        ok = status == expect
+        with self._lock:
+            self.latencies[step].append(elapsed)
+            if not ok:
+                self.errors[step] += 1
+        if not ok:
+            logger.debug("%s %s: статус %s вместо %s", method, path, status, expect)
+            return None
+        return status, location, body
+
+
+def sign_in(client, email, password, attempts=5):
+    """Входим под пользователем нагрузки, при первом запуске регистрируем его"""
+    credentials = {'email': email, 'password': password}
+    registered = False
+    for _ in range(attempts):
+        status, location, _ = client.request('POST', '/login', credentials)
+        if status == 302 and '/login' not in location:
+            return True
+        if status in (429, 503):
+            # Ограничитель входа или перегруженный пул хэширования: ждем и повторяем
+            time.sleep(1)
+            continue
+        if registered:
+            return False
+        status, _, _ = client.request('POST', '/register', dict(
+            credentials, first_name='Нагрузка', last_name=email.split('@')[0]))
+        registered = status == 302
+        if status in (429, 503):
+            time.sleep(1)
+    return False
+
+
+def seed_catalog(count):
+    """Дополняем каталог до count активных товаров bench-product-<n> в базе из DB_*.
+
+    Пишет в базу напрямую, поэтому запускается только на отдельной тестовой
+    базе. Товары создаются в категории "bench", повторный запуск добавляет
+    только недостающие. Возвращает id всех товаров нагрузки.
+    """
+    import psycopg2  # нужен только для заполнения
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    images = sorted(f'images/products/{name}' for name in os.listdir(PRODUCT_IMAGES_DIR))
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        database=os.getenv('DB_DATABASE'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+    )
+    try:
+        cur = conn.cursor()
+        # У category и product нет последовательностей, id выдаются через MAX(id)
+        cur.execute('LOCK TABLE category, product IN EXCLUSIVE MODE;')
+        cur.execute("SELECT id FROM category WHERE название = 'bench';")
+        row = cur.fetchone()
+        if row:
+            category_id = row[0]
+        else:
+            cur.execute('''
+                INSERT INTO category (id, название, описание, активна)
+                SELECT COALESCE(MAX(id), 0) + 1, 'bench', 'Товары нагрузочного теста', true FROM category
+                RETURNING id;
+            ''')
+            category_id = cur.fetchone()[0]
+
+        cur.execute("SELECT COUNT(*) FROM product WHERE категория_id = %s AND активен;", (category_id,))
+        existing = cur.fetchone()[0]
+        if existing < count:
+            cur.execute('SELECT COALESCE(MAX(id), 0) FROM product;')
+            base_id = cur.fetchone()[0]
+            # Цены, цвета, размеры и картинки детерминированы номером товара
+            cur.execute('''
+                INSERT INTO product (id, название, цена, цвет, размер, изображение, категория_id, активен)
+                SELECT %(base)s + n - %(existing)s, 'bench-product-' || n, 100 + (n * 7919) %% 9900,
+                       (ARRAY['черный', 'белый', 'красный', 'синий'])[1 + n %% 4],
+                       (ARRAY['S', 'M', 'L', 'XL'])[1 + n %% 4],
+                       (%(images)s::text[])[1 + n %% %(image_count)s],
+                       %(category)s, true
+                FROM generate_series(%(existing)s + 1, %(count)s) AS n;
+            ''', {'base': base_id, 'existing': existing, 'count': count, 'images': images,
+                  'image_count': len(images), 'category': category_id})
+            logger.info("Добавлено товаров нагрузки: %d", count - existing)
+
+        cur.execute('SELECT id FROM product WHERE категория_id = %s AND активен ORDER BY id;', (category_id,))
+        products = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        cur.close()
+        return products
+    finally:
+        conn.close()
+
+
+def run_journey(client, recorder, products, args, rng):
+    """Один проход пути покупателя; False, если путь прервался"""
+    if not recorder.call('index', client, 'GET', '/'):
+        return False
+
+    path = '/catalog'
+    page_products = []
+    for _ in range(args.catalog_pages):
+        result = recorder.call('catalog', client, 'GET', path)
+        if not result:
+            return False
+        page_products.extend(int(product_id) for product_id in PRODUCT_LINK.findall(result[2]))
+        next_page = NEXT_PAGE_LINK.search(result[2])
+        if not next_page:
+            break
+        path = f'/catalog?after={next_page.group(1)}'
+
+    candidates = sorted(set(page_products)) or products
+    for product_id in rng.sample(candidates, min(args.cart_items, len(candidates))):
+        if not recorder.call('product_detail', client, 'GET', f'/product/{product_id}'):
+            return False
+        if not recorder.call('add_to_cart', client, 'GET', f'/add_to_cart/{product_id}', expect=302):
+            return False
+
+    if not recorder.call('view_cart', client, 'GET', '/cart'):
+        return False
+    if not recorder.call('checkout_form', client, 'GET', '/checkout'):
+        return False
+    result = recorder.call('checkout', client, 'POST', '/checkout',
+                           {'shipping_address': 'г. Москва, ул. Нагрузочная, д. 1'}, expect=302)
+    order = PAYMENT_LOCATION.search(result[1]) if result else None
+    if not order:
+        return False
+    order_id = order.group(1)
+
+    if not recorder.call('payment_form', client, 'GET', f'/payment/{order_id}'):
+        return False
+    if not recorder.call('payment', client, 'POST', f'/payment/{order_id}',
+                         {'payment_method': 'карта'}, expect=302):
+        return False
+    return bool(recorder.call('my_orders', client, 'GET', '/my_orders'))
+
+
+def scrape_metrics(client, token):
+    """Число HTTP- и SQL-запросов по эндпоинтам из /metrics"""
+    status, _, body = client.request('GET', '/metrics', headers={'Authorization': f'Bearer {token}'})
+    if status != 200:
+        raise RuntimeError(f'/metrics вернул {status}')
+    totals = defaultdict(lambda: {'requests': 0, 'db_queries': 0})
+    for line in body.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match:
+            continue
+        labels = dict(METRIC_LABEL.findall(match.group(2)))
+        key = 'requests' if match.group(1) == 'http_requests_total' else 'db_queries'
+        totals[labels.get('endpoint')][key] += float(match.group(3))
+    return totals
+
+
+def percentile(sorted_values, p):
+    """Перцентиль методом ближайшего ранга"""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def git_revision():
+    """Ветка и коммит рабочей копии, чтобы результаты разных веток не путались"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+        branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], text=True).strip()
+        return {'branch': branch, 'commit': commit}
+    except (OSError, subprocess.CalledProcessError):
+        return {'branch': None, 'commit': None}
+
+
+def build_report(recorder, before, after, started_at, duration, args, completed):
+    routes = {}
+    for step, endpoint in STEPS:
+        latencies = sorted(recorder.latencies.get(step, ()))
+        if not latencies:
+            continue
+        requests_delta = after[endpoint]['requests'] - before[endpoint]['requests']
+        queries_delta = after[endpoint]['db_queries'] - before[endpoint]['db_queries']
+        routes[step] = {
+            'endpoint': endpoint,
+            'requests': len(latencies),
+            'errors': recorder.errors.get(step, 0),
+            'rps': round(len(latencies) / duration, 2),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+            'db_queries_per_request': round(queries_delta / requests_delta, 2) if requests_delta else None,
+        }
+    total_requests = sum(route['requests'] for route in routes.values())
+    return {
+        'meta': dict(
+            git_revision(),
+            started_at=started_at.isoformat(timespec='seconds'),
+            mode='http' if args.url else 'app',
+            url=args.url,
+            concurrency=args.concurrency,
+            users=args.users,
+            iterations=args.iterations,
+            cart_items=args.cart_items,
+            catalog_pages=args.catalog_pages,
+            products=args.products or None,
+            python=platform.python_version(),
+        ),
+        'total': {
+            'duration_s': round(duration, 3),
+            'journeys': args.users * args.iterations,
+            'completed_journeys': completed,
+            'requests': total_requests,
+            'errors': sum(route['errors'] for route in routes.values()),
+            'rps': round(total_requests / duration, 2),
+        },
+        'routes': routes,
+    }
+
+
+def print_report(report, baseline=None):
+    header = f"{'шаг':<16}{'запросов':>9}{'ошибок':>8}{'rps':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'SQL/запр':>10}"
+    if baseline:
+        header += f"{'p95 было':>10}{'Δp95':>8}{'SQL было':>10}"
+    print(header)
+    for step, route in report['routes'].items():
+        queries = route['db_queries_per_request']
+        line = (f"{step:<16}{route['requests']:>9}{route['errors']:>8}{route['rps']:>9}"
+                f"{route['p50_ms']:>9}{route['p95_ms']:>9}{route['p99_ms']:>9}"
+                f"{'-' if queries is None else queries:>10}")
+        old = (baseline or {}).get('routes', {}).get(step)
+        if old:
+            change = (route['p95_ms'] / old['p95_ms'] - 1) * 100 if old['p95_ms'] else 0
+            old_queries = old['db_queries_per_request']
+            line += f"{old['p95_ms']:>10}{change:>+7.0f}%{'-' if old_queries is None else old_queries:>10}"
+        print(line)
+    total = report['total']
+    print(f"Итого: {total['requests']} запросов за {total['duration_s']} с, {total['rps']} rps, "
+          f"ошибок {total['errors']}, путей пройдено {total['completed_journeys']} из {total['journeys']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест пути покупателя')
+    parser.add_argument('--url', help='адрес запущенного сервера; без него приложение запускается в процессе')
+    parser.add_argument('--concurrency', type=int, default=8, help='одновременных пользователей')
+    parser.add_argument('--users', type=int, default=16, help='аккаунтов нагрузки')
+    parser.add_argument('--iterations', type=int, default=5, help='проходов пути на пользователя')
+    parser.add_argument('--cart-items', type=int, default=2, help='товаров в корзине на один заказ')
+    parser.add_argument('--catalog-pages', type=int, default=1, help='страниц каталога на один проход')
+    parser.add_argument('--password', default='bench-password')
+    parser.add_argument('--seed', type=int, default=1, help='seed выбора товаров')
+    parser.add_argument('--products', type=int, default=0,
+                        help='дополнить каталог до N товаров нагрузки, записывая их в базу DB_* '
+                             '(только для отдельной тестовой базы); без него используется '
+                             'каталог, который уже есть в базе')
+    parser.add_argument('--metrics-wait', type=float, default=0.0,
+                        help='сколько секунд ждать сброса метрик воркеров перед чтением /metrics')
+    parser.add_argument('--admin-token', default=os.getenv('ADMIN_TOKEN', ''),
+                        help='токен для чтения /metrics (ADMIN_TOKEN сервера)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='JSON с результатом другой ветки для сравнения')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    # Каталог заполняется до запуска приложения, чтобы его кэш не видел старый каталог
+    seeded = seed_catalog(args.products) if args.products > 0 else None
+
+    if args.url:
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        # Все запросы идут с одного адреса, поэтому лимиты входа снимаем;
+        # потоков больше, чем соединений в пуле по умолчанию
+        os.environ.setdefault('AUTH_IP_PER_MINUTE', '1000000')
+        os.environ.setdefault('AUTH_EMAIL_PER_MINUTE', '1000000')
+        os.environ.setdefault('DB_POOL_MAX', str(max(10, args.concurrency)))
+        # Приложение в процессе получает тот же токен, которым читается /metrics
+        args.admin_token = args.admin_token or secrets.token_hex(16)
+        os.environ['ADMIN_TOKEN'] = args.admin_token
+        from app import app
+
+        def make_client():
+            return AppClient(app)
+
+    control = make_client()
+    status, _, body = control.request('GET', '/catalog')
+    products = sorted({int(product_id) for product_id in PRODUCT_LINK.findall(body)})
+    if seeded:
+        # Товары выбираются из всего заполненного каталога, а не с первой страницы
+        products = seeded
+    if status != 200 or not products:
+        parser.error(f'в каталоге нет товаров (статус {status})')
+
+    clients = [make_client() for _ in range(args.users)]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        signed_in = list(executor.map(
+            lambda item: sign_in(item[1], f'bench-{item[0]}@example.com', args.password), enumerate(clients)))
+    if not all(signed_in):
+        parser.error(f'не удалось войти под {signed_in.count(False)} пользователями нагрузки')
+    logger.info("Пользователей: %d, товаров в каталоге: %d, потоков: %d",
+                args.users, len(products), args.concurrency)
+
+    recorder = Recorder()
+
+    def run_user(index):
+        client = clients[index]
+        rng = random.Random(args.seed * 100003 + index)
+        return sum(run_journey(client, recorder, products, args, rng) for _ in range(args.iterations))
+
+    before = scrape_metrics(control, args.admin_token)
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        completed = sum(executor.map(run_user, range(args.users)))
+    duration = time.perf_counter() - started
+    time.sleep(args.metrics_wait)
+    after = scrape_metrics(control, args.admin_token)
+
+    report = build_report(recorder, before, after, started_at, duration, args, completed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    logger.info("Результат сохранен в %s", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Кэш в памяти процесса с TTL и вытеснением LRU"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Потокобезопасный кэш ограниченного размера.
+
+    Записи живут не дольше ttl секунд, при переполнении вытесняется
+    запись, к которой дольше всего не обращались. Кроме числа записей
+    можно ограничить их суммарный вес: weigh(value) - вес значения
+    (например, число строк), maxweight - предел суммы. Значение тяжелее
+    maxweight не кэшируется.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, maxweight=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self._data = OrderedDict()  # key -> (значение, срок годности)
+        self._weights = {}  # key -> вес записи, если задан weigh
+        self._weight = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        """Значение из кэша или default, если записи нет или она устарела"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self._hits += 1
+                    return value
+                self._remove(key)
+            self._misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Кладем значение в кэш"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def _entry_weight(self, value):
+        return self.weigh(value) if self.weigh is not None else 0
+
+    def _store(self, key, value, expires_at):
+        # Вызывается под self._lock
+        self._remove(key)
+        weight = self._entry_weight(value)
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+        self._data[key] = (value, expires_at)
+        if weight:
+            self._weights[key] = weight
+            self._weight += weight
+        while len(self._data) > self.maxsize or \
+                (self.maxweight is not None and self._weight > self.maxweight):
+            self._remove(next(iter(self._data)))
+            self._evictions += 1
+
+    def _remove(self, key):
+        # Вызывается под self._lock
+        if self._data.pop(key, _MISSING) is not _MISSING:
+            self._weight -= self._weights.pop(key, 0)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Значение из кэша, а при промахе - результат loader(), который тоже кэшируется"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key=None):
+        """Удаляем одну запись или, без аргумента, весь кэш"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+                self._weights.clear()
+                self._weight = 0
+            else:
+                self._remove(key)
+
+    def invalidate_where(self, predicate):
+        """Удаляем записи, для ключей которых predicate(key) истинно"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self._remove(key)
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'weight': self._weight,
+                'maxweight': self.maxweight,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': round(self._hits / total, 4) if total else 0.0,
+            }
+
+
+class StaleWhileRevalidateCache(TTLCache):
+    """TTLCache, который после ttl еще stale_ttl секунд отдает устаревшее значение.
+
+    get(key, refresh=...) возвращает устаревшее значение сразу и запускает
+    refresh() в фоновом потоке (не больше одного обновления на ключ).
+    refresh() возвращает новое значение или None, чтобы удалить запись.
+    Если во время обновления кэш сбросили, его результат отбрасывается;
+    то же для set(..., generation=g) со значением generation() до загрузки.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, stale_ttl=60.0, maxweight=None, weigh=None):
+        super().__init__(maxsize, ttl, maxweight, weigh)
+        self.stale_ttl = stale_ttl
+        self._refreshing = set()
+        self._generation = 0
+        self._stale_hits = 0
+        self._refreshes = 0
+
+    def get(self, key, default=None, refresh=None):
+        entry = super().get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        value, fresh_until, ttl = entry
+        if fresh_until <= time.monotonic():
+            with self._lock:
+                self._stale_hits += 1
+            if refresh is not None:
+                self._start_refresh(key, refresh, ttl)
+        return value
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Кладем значение в кэш, если он не сбрасывался после generation()"""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.monotonic()
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._store(key, (value, now + ttl, ttl), now + ttl + self.stale_ttl)
+
+    def generation(self):
+        """Счетчик сбросов: запоминается до загрузки значения и передается в set"""
+        with self._lock:
+            return self._generation
+
+    def _entry_weight(self, value):
+        # Хранится (значение, свежо до, ttl), вес считается по самому значению
+        return super()._entry_weight(value[0])
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+        super().invalidate(key)
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            self._generation += 1
+        super().invalidate_where(predicate)
+
+    def _start_refresh(self, key, refresh, ttl):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            generation = self._generation
+        threading.Thread(target=self._refresh, args=(key, refresh, ttl, generation),
+                         name='cache-refresh', daemon=True).start()
+
+    def _refresh(self, key, refresh, ttl, generation):
+        try:
+            value = refresh()
+        except Exception:
+            logger.exception("Ошибка фонового обновления записи кэша %r", key)
+            value = _MISSING
+        now = time.monotonic()
+        with self._lock:
+            self._refreshing.discard(key)
+            if value is _MISSING or generation != self._generation:
+                return
+            self._refreshes += 1
+            if value is None:
+                self._remove(key)
+            else:
+                self._store(key, (value, now + ttl, ttl), now + ttl + self.stale_ttl)
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update(stale_ttl=self.stale_ttl, stale_hits=self._stale_hits,
+                         refreshes=self._refreshes, refreshing=len(self._refreshing))
+        return stats
@@ -0,0 +1,285 @@
+"""Пул соединений с PostgreSQL для воркеров приложения"""
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+# Наблюдатели за запросами: observer(cursor, query, params, duration)
+query_observers = []
+
+
+class InstrumentedCursor(extensions.cursor):
+    """Курсор, который замеряет время каждого запроса и сообщает наблюдателям"""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._notify(query, vars, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._notify(query, None, time.perf_counter() - start)
+
+    def _notify(self, query, params, duration):
+        for observer in query_observers:
+            try:
+                observer(self, query, params, duration)
+            except Exception:
+                logger.exception("Ошибка в наблюдателе запросов")
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с проверкой живости при выдаче.
+
+    Пул создается на процесс: после fork (gunicorn воркеры) унаследованные
+    соединения отбрасываются и пул наполняется заново.
+    """
+
+    def __init__(self, db_config, maxconn=10, timeout=5.0, check_after=30.0):
+        self.db_config = db_config
+        self.maxconn = maxconn
+        self.timeout = timeout
+        # Соединения, простоявшие дольше check_after секунд, проверяем при выдаче
+        self.check_after = check_after
+
+        self._lock = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []  # [(conn, время возврата в пул)]
+        self._in_use = set()
+        self._opening = 0
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'connects': 0,
+            'discarded': 0,
+        }
+
+    def _check_pid(self):
+        # Соединения родительского процесса использовать нельзя и закрывать тоже:
+        # закрытие отправит Terminate по общему сокету
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _is_alive(self, conn):
+        # Вызывается без self._lock: это запрос к серверу
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._stats['discarded'] += 1
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Берем соединение из пула, при необходимости ждем освобождения"""
+        start = time.monotonic()
+        waited = False
+        while True:
+            conn, check, waited = self._checkout(start, waited)
+            # Проверка живости идет вне блокировки, чтобы медленное или
+            # зависшее соединение не задерживало выдачу остальных
+            if not check or self._is_alive(conn):
+                break
+            # Мертвое соединение освобождает слот, пробуем следующее
+            with self._lock:
+                if conn in self._in_use:
+                    self._in_use.discard(conn)
+                    self._stats['discarded'] += 1
+                    self._lock.notify()
+            self._close(conn)
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            if waited:
+                wait_time = time.monotonic() - start
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+        return conn
+
+    def _checkout(self, start, waited):
+        """Соединение, помеченное занятым: (conn, нужна ли проверка живости, ждали ли)"""
+        with self._lock:
+            self._check_pid()
+            while True:
+                conn = None
+                check = False
+                while self._idle:
+                    candidate, idle_since = self._idle.pop()
+                    if candidate.closed:
+                        self._discard(candidate)
+                        continue
+                    conn = candidate
+                    # Соединения, простоявшие дольше check_after, проверяем через SELECT 1
+                    check = time.monotonic() - idle_since >= self.check_after
+                    break
+
+                if conn is not None:
+                    break
+
+                if len(self._in_use) + self._opening < self.maxconn:
+                    # Новое соединение открываем вне блокировки, слот резервируем заранее
+                    self._opening += 1
+                    self._lock.release()
+                    try:
+                        conn = psycopg2.connect(cursor_factory=InstrumentedCursor, **self.db_config)
+                    finally:
+                        self._lock.acquire()
+                        self._opening -= 1
+                        if conn is None:
+                            self._lock.notify()
+                    self._stats['connects'] += 1
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'Нет свободных соединений за {self.timeout} с')
+
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                self._lock.wait(remaining)
+
+            self._in_use.add(conn)
+            return conn, check, waited
+
+    def putconn(self, conn):
+        """Возвращаем соединение в пул, откатывая незавершенную транзакцию"""
+        with self._lock:
+            self._check_pid()
+            if conn not in self._in_use:
+                return
+            self._in_use.discard(conn)
+
+            if not conn.closed:
+                try:
+                    if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    pass
+
+            if conn.closed or conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+
+            self._lock.notify()
+
+    def closeall(self):
+        """Закрываем все простаивающие соединения"""
+        with self._lock:
+            self._check_pid()
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+
+    def stats(self):
+        """Текущая статистика пула"""
+        with self._lock:
+            self._check_pid()
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._in_use)
+            stats['idle'] = len(self._idle)
+            stats['maxconn'] = self.maxconn
+            stats['pid'] = self._pid
+            return stats
+
+
+class ChangeListener:
+    """Фоновый поток LISTEN: вызывает обработчики на NOTIFY из PostgreSQL.
+
+    Поток запускается отдельно в каждом процессе. После (пере)подключения
+    обработчики вызываются без payload, так как уведомления за время
+    разрыва потеряны.
+    """
+
+    def __init__(self, db_config, reconnect_delay=5.0):
+        self.db_config = db_config
+        self.reconnect_delay = reconnect_delay
+        self._handlers = {}  # канал -> [обработчики]
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def subscribe(self, channel, handler):
+        """Подписываем handler(payload) на канал"""
+        with self._lock:
+            self._handlers.setdefault(channel, []).append(handler)
+
+    def start(self):
+        """Запускаем поток, если в этом процессе он еще не запущен"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='pg-listener', daemon=True)
+            thread.start()
+
+    def _dispatch(self, channel, payload):
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception("Ошибка в обработчике уведомления %s", channel)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_config)
+                conn.autocommit = True
+                cur = conn.cursor()
+                for channel in self._handlers:
+                    cur.execute(f'LISTEN {channel};')
+                cur.close()
+
+                for channel in self._handlers:
+                    self._dispatch(channel, None)
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch(notify.channel, notify.payload)
+            except Exception as e:
+                logger.warning("Ошибка LISTEN-соединения: %s", e)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+            time.sleep(self.reconnect_delay)
@@ -0,0 +1,9 @@
+"""Настройки gunicorn (файл подхватывается автоматически из текущего каталога)"""
+import os
+import uuid
+
+
+def on_starting(server):
+    """Новый идентификатор запуска до создания воркеров: по нему metrics.py
+    отделяет снимки метрик этого запуска от оставшихся с прошлых"""
+    os.environ['METRICS_SERVER_ID'] = uuid.uuid4().hex[:12]
@@ -0,0 +1,95 @@
+"""Логирование через очередь: поток запроса не ждет записи в stdout"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не блокирует"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет в запись id текущего запроса"""
+
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_listener = None
+
+
+def _start_listener(handler):
+    global _listener
+    _listener = QueueListener(handler.queue, *handler.targets, respect_handler_level=True)
+    _listener.start()
+
+
+def setup_logging(app):
+    """Настраиваем корневой логгер и id запросов для приложения.
+
+    LOG_LEVEL - уровень (по умолчанию INFO, отладочные дампы пишутся на DEBUG),
+    LOG_FORMAT - text или json, LOG_QUEUE_SIZE - размер очереди записей.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if os.getenv('LOG_FORMAT', 'text') == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'))
+
+    queue_handler = DroppingQueueHandler(queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', 10000))))
+    queue_handler.targets = (stream_handler,)
+    # Фильтр на QueueHandler: id запроса берется в потоке запроса, а не в потоке записи
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    _start_listener(queue_handler)
+    atexit.register(lambda: _listener.stop())
+    # Потоки не переживают fork (gunicorn --preload), перезапускаем в дочернем процессе
+    os.register_at_fork(after_in_child=lambda: _start_listener(queue_handler))
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+
+    @app.after_request
+    def return_request_id(response):
+        response.headers['X-Request-ID'] = g.get('request_id', '')
+        return response
@@ -0,0 +1,282 @@
+"""Метрики запросов в текстовом формате Prometheus.
+
+Каждый воркер копит метрики в памяти. Если задан METRICS_DIR, воркер
+периодически сбрасывает снимок в файл metrics_<запуск>_<pid>_<метка>.json,
+а /metrics суммирует снимки всех воркеров текущего запуска сервера.
+Файлы завершившихся воркеров этого запуска не удаляются, чтобы счетчики
+не уменьшались, а метка процесса не дает новому воркеру с тем же pid
+перезаписать снимок старого. Снимки прошлых запусков удаляются.
+
+Запуск сервера определяет METRICS_SERVER_ID: gunicorn.conf.py задает его
+в мастере до создания воркеров, без него берется pid родителя.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Counter:
+    """Счетчик с метками"""
+
+    type = 'counter'
+
+    def __init__(self, name, help_text, labelnames, lock=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = lock or threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def merge(self, labels, value):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Histogram:
+    """Гистограмма с метками: количество в каждой корзине, сумма и число наблюдений"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames, buckets, lock=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}  # labels -> [счетчики корзин..., +Inf, сумма]
+        self._lock = lock or threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            else:
+                data[len(self.buckets)] += 1
+            data[-1] += value
+
+    def merge(self, labels, value):
+        data = self.values.setdefault(labels, [0] * (len(self.buckets) + 2))
+        for i, item in enumerate(value):
+            data[i] += item
+
+    def samples(self):
+        for labels, data in sorted(self.values.items()):
+            base = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), data[:-1]):
+                cumulative += count
+                yield f'{self.name}_bucket', dict(base, le=str(bound)), cumulative
+            yield f'{self.name}_sum', base, data[-1]
+            yield f'{self.name}_count', base, cumulative
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class Registry:
+    """Набор метрик процесса со сбросом снимков для агрегации между воркерами"""
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._metrics = {}
+        self._flusher_pid = None
+        self._snapshot_name = None  # (pid, имя файла снимка процесса)
+
+    def counter(self, name, help_text, labelnames):
+        metric = Counter(name, help_text, labelnames, self.lock)
+        self._metrics[name] = metric
+        return metric
+
+    def histogram(self, name, help_text, labelnames, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets, self.lock)
+        self._metrics[name] = metric
+        return metric
+
+    def snapshot(self):
+        """Значения метрик процесса в виде, пригодном для JSON"""
+        with self.lock:
+            return {
+                name: [[list(labels), list(value) if isinstance(value, list) else value]
+                       for labels, value in metric.values.items()]
+                for name, metric in self._metrics.items()
+            }
+
+    def _server_prefix(self):
+        server_id = os.getenv('METRICS_SERVER_ID') or f'ppid{os.getppid()}'
+        return f'metrics_{server_id}_'
+
+    def _snapshot_path(self):
+        pid = os.getpid()
+        if self._snapshot_name is None or self._snapshot_name[0] != pid:
+            self._snapshot_name = (pid, f'{self._server_prefix()}{pid}_{time.time_ns():x}.json')
+        return os.path.join(self.directory, self._snapshot_name[1])
+
+    def remove_stale_snapshots(self):
+        """Удаляем снимки прошлых запусков сервера"""
+        prefix = self._server_prefix()
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json*')):
+            if not os.path.basename(path).startswith(prefix):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def flush(self):
+        """Сбрасываем снимок процесса в METRICS_DIR"""
+        if not self.directory:
+            return
+        path = self._snapshot_path()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self):
+        """Фоновый сброс снимков, запускается отдельно в каждом процессе"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove_stale_snapshots()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning("Не удалось сохранить метрики: %s", e)
+
+    def collect(self):
+        """Снимки всех воркеров (свой берется из памяти)"""
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own_path = self._snapshot_path()
+            for path in glob.glob(os.path.join(self.directory, f'{self._server_prefix()}*.json')):
+                if path == own_path:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return snapshots
+
+    def render(self):
+        """Суммарные метрики всех воркеров в текстовом формате Prometheus"""
+        merged = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Histogram):
+                merged[name] = Histogram(name, metric.help, metric.labelnames, metric.buckets)
+            else:
+                merged[name] = Counter(name, metric.help, metric.labelnames)
+
+        for snapshot in self.collect():
+            for name, values in snapshot.items():
+                if name not in merged:
+                    continue
+                for labels, value in values:
+                    merged[name].merge(tuple(labels), value)
+
+        lines = []
+        for metric in merged.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for sample_name, labels, value in metric.samples():
+                lines.append(f'{sample_name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(os.getenv('METRICS_DIR'), float(os.getenv('METRICS_FLUSH_INTERVAL', 5)))
+
+http_requests_total = registry.counter(
+    'http_requests_total', 'Число HTTP-запросов', ('endpoint', 'method', 'status'))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Время обработки HTTP-запроса', ('endpoint',))
+db_queries_total = registry.counter(
+    'db_queries_total', 'Число SQL-запросов', ('endpoint',))
+db_query_duration_total = registry.counter(
+    'db_query_duration_seconds_total', 'Суммарное время SQL-запросов', ('endpoint',))
+db_queries_per_request = registry.histogram(
+    'db_queries_per_request', 'Число SQL-запросов на один HTTP-запрос', ('endpoint',),
+    buckets=QUERY_COUNT_BUCKETS)
+template_render_duration = registry.histogram(
+    'template_render_duration_seconds', 'Время рендеринга шаблонов за HTTP-запрос', ('endpoint',))
+
+
+def observe_query(cursor, query, params, duration):
+    """Наблюдатель db.query_observers: учитываем запрос в метриках текущего HTTP-запроса"""
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_time += duration
+
+
+def setup_metrics(app):
+    """Подключаем сбор метрик к приложению"""
+
+    @app.before_request
+    def start_request_metrics():
+        registry.start_flusher()
+        g.metrics_start = time.perf_counter()
+        g.metrics_db_queries = 0
+        g.metrics_db_time = 0.0
+        g.metrics_render_time = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_start' not in g:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        http_requests_total.inc((endpoint, request.method, str(response.status_code)))
+        http_request_duration.observe((endpoint,), time.perf_counter() - g.metrics_start)
+        db_queries_total.inc((endpoint,), g.metrics_db_queries)
+        db_query_duration_total.inc((endpoint,), g.metrics_db_time)
+        db_queries_per_request.observe((endpoint,), g.metrics_db_queries)
+        template_render_duration.observe((endpoint,), g.metrics_render_time)
+        return response
+
+    def template_started(sender, template, context, **extra):
+        g.metrics_render_started = time.perf_counter()
+
+    def template_finished(sender, template, context, **extra):
+        started = g.pop('metrics_render_started', None)
+        if started is not None and 'metrics_start' in g:
+            g.metrics_render_time += time.perf_counter() - started
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
@@ -0,0 +1,269 @@
+"""Версионные миграции схемы базы (каталог migrations/).
+
+    python migrate.py [status | up [версия] | down версия | check]
+
+Миграция - пара файлов NNNN_имя.up.sql и NNNN_имя.down.sql. Примененные
+версии записываются в таблицу schema_version. up применяет новые миграции
+по возрастанию версии (до указанной включительно), down откатывает
+примененные миграции новее указанной версии. Каждая миграция выполняется
+в своей транзакции вместе с записью в schema_version; файлы с пометкой
+"-- migrate: no-transaction" (CREATE INDEX CONCURRENTLY) выполняются
+по одной команде вне транзакции и должны быть идемпотентными.
+
+check (и flask check-schema, и запуск app.py напрямую) проверяет, что
+у горячих запросов есть индексы из REQUIRED_INDEXES.
+"""
+import argparse
+import glob
+import logging
+import os
+import re
+import sys
+from collections import namedtuple
+
+import psycopg2
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.up\.sql$')
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+# Ключ advisory-блокировки: миграции в один момент применяет только один процесс
+MIGRATE_LOCK_KEY = 7412002
+
+# Индексы, без которых горячие запросы уходят в последовательное сканирование:
+# таблица и первые колонки индекса. Подходит любой действительный индекс без
+# условия WHERE, который начинается с этих колонок.
+REQUIRED_INDEXES = (
+    ('cart', ('пользователь_id', 'товар_id')),
+    ('order_items', ('order_id',)),
+    ('review', ('одобрен', 'дата_создания')),
+    ('product', ('активен', 'категория_id')),
+    ('payment', ('заказ_id',)),
+    ('user', ('email',)),
+    ('order', ('пользователь_id', 'дата_создания')),
+)
+
+Migration = namedtuple('Migration', 'version name up_path down_path')
+
+
+class SchemaError(Exception):
+    """Схема базы не соответствует требованиям приложения"""
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Миграции из каталога по возрастанию версии"""
+    migrations = []
+    for path in glob.glob(os.path.join(directory, '*.up.sql')):
+        match = MIGRATION_FILE.match(os.path.basename(path))
+        if not match:
+            continue
+        down_path = path[:-len('.up.sql')] + '.down.sql'
+        migrations.append(Migration(int(match.group(1)), match.group(2), path,
+                                    down_path if os.path.exists(down_path) else None))
+    migrations.sort()
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise SchemaError(f'Повторяющиеся номера миграций в {directory}')
+    return migrations
+
+
+def ensure_version_table(conn):
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version    integer PRIMARY KEY,
+            name       text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        );
+    ''')
+    conn.commit()
+    cur.close()
+
+
+def applied_versions(conn):
+    """Примененные версии; пустое множество, если миграции еще не запускались"""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        cur.close()
+        return set()
+    cur.execute('SELECT version FROM schema_version;')
+    versions = {row[0] for row in cur.fetchall()}
+    cur.close()
+    return versions
+
+
+def split_statements(sql):
+    """Команды файла без транзакции: по одной на каждую ';' в конце строки"""
+    statements = []
+    for chunk in re.split(r';\s*$', sql, flags=re.M):
+        lines = [line for line in chunk.splitlines() if line.strip() and not line.strip().startswith('--')]
+        if lines:
+            statements.append('\n'.join(lines))
+    return statements
+
+
+def run_script(conn, path, record_sql, record_params):
+    """Выполняем файл миграции и запись в schema_version"""
+    with open(path, encoding='utf-8') as f:
+        sql = f.read()
+    cur = conn.cursor()
+    if NO_TRANSACTION not in sql:
+        try:
+            cur.execute(sql)
+            cur.execute(record_sql, record_params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        return
+
+    # Команды вроде CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции.
+    # Если миграция прервется, она повторится целиком при следующем запуске
+    conn.autocommit = True
+    try:
+        for statement in split_statements(sql):
+            cur.execute(statement)
+        cur.execute(record_sql, record_params)
+    finally:
+        conn.autocommit = False
+        cur.close()
+
+
+def lock(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_lock(%s);', (MIGRATE_LOCK_KEY,))
+    conn.commit()
+    cur.close()
+
+
+def unlock(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_unlock(%s);', (MIGRATE_LOCK_KEY,))
+    conn.commit()
+    cur.close()
+
+
+def migrate_up(conn, target=None, migrations=None):
+    """Применяем новые миграции до версии target включительно (по умолчанию все)"""
+    migrations = load_migrations() if migrations is None else migrations
+    ensure_version_table(conn)
+    lock(conn)
+    try:
+        applied = applied_versions(conn)
+        for migration in migrations:
+            if migration.version in applied or (target is not None and migration.version > target):
+                continue
+            logger.info("Применяем миграцию %04d_%s", migration.version, migration.name)
+            run_script(conn, migration.up_path,
+                       'INSERT INTO schema_version (version, name) VALUES (%s, %s);',
+                       (migration.version, migration.name))
+    finally:
+        unlock(conn)
+
+
+def migrate_down(conn, target, migrations=None):
+    """Откатываем примененные миграции новее версии target, начиная с последней"""
+    migrations = load_migrations() if migrations is None else migrations
+    ensure_version_table(conn)
+    lock(conn)
+    try:
+        applied = applied_versions(conn)
+        for migration in reversed(migrations):
+            if migration.version not in applied or migration.version <= target:
+                continue
+            if migration.down_path is None:
+                raise SchemaError(f'У миграции {migration.version:04d}_{migration.name} нет down-скрипта')
+            logger.info("Откатываем миграцию %04d_%s", migration.version, migration.name)
+            run_script(conn, migration.down_path,
+                       'DELETE FROM schema_version WHERE version = %s;', (migration.version,))
+    finally:
+        unlock(conn)
+
+
+def missing_indexes(conn):
+    """Требуемые индексы из REQUIRED_INDEXES, которых нет в базе"""
+    cur = conn.cursor()
+    # Колонки индексов-выражений попадают в список как NULL и ни с чем не совпадают
+    cur.execute('''
+        SELECT t.relname, array_agg(a.attname ORDER BY k.ord)
+        FROM pg_index i
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+        LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE n.nspname = current_schema()
+          AND t.relname = ANY(%s)
+          AND i.indisvalid
+          AND i.indpred IS NULL
+        GROUP BY i.indexrelid, t.relname;
+    ''', ([table for table, _ in REQUIRED_INDEXES],))
+    indexes = cur.fetchall()
+    conn.rollback()
+    cur.close()
+    return [
+        (table, columns) for table, columns in REQUIRED_INDEXES
+        if not any(name == table and tuple(index_columns[:len(columns)]) == columns
+                   for name, index_columns in indexes)
+    ]
+
+
+def check_schema(conn, migrations=None):
+    """Проверка перед запуском приложения: SchemaError, если не хватает индексов"""
+    migrations = load_migrations() if migrations is None else migrations
+    applied = applied_versions(conn)
+    pending = [migration for migration in migrations if migration.version not in applied]
+    conn.rollback()
+    if pending:
+        logger.warning("Не применены миграции: %s (python migrate.py up)",
+                       ', '.join(f'{m.version:04d}_{m.name}' for m in pending))
+    missing = missing_indexes(conn)
+    if missing:
+        raise SchemaError('Нет индексов: ' + ', '.join(
+            f'{table}({", ".join(columns)})' for table, columns in missing) + ' (python migrate.py up)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Миграции схемы базы данных')
+    parser.add_argument('command', nargs='?', default='status', choices=('status', 'up', 'down', 'check'))
+    parser.add_argument('version', nargs='?', type=int, help='целевая версия для up и down')
+    args = parser.parse_args()
+    if args.command == 'down' and args.version is None:
+        parser.error('для down нужна целевая версия (0 - откатить все)')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    load_dotenv()
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        database=os.getenv('DB_DATABASE'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+    )
+    try:
+        if args.command == 'up':
+            migrate_up(conn, args.version)
+        elif args.command == 'down':
+            migrate_down(conn, args.version)
+        elif args.command == 'check':
+            check_schema(conn)
+            logger.info("Все требуемые индексы на месте")
+            return
+
+        applied = applied_versions(conn)
+        for migration in load_migrations():
+            mark = 'x' if migration.version in applied else ' '
+            print(f'[{mark}] {migration.version:04d}_{migration.name}')
+    except SchemaError as e:
+        logger.error("%s", e)
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
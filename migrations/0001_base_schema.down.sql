@@ -0,0 +1,3 @@
+-- Удаляет все данные магазина: откатывать только пустую или тестовую базу.
+
+DROP TABLE IF EXISTS review, payment, order_items, "order", cart, "user", product, category;
@@ -0,0 +1,80 @@
+-- Основные таблицы магазина. В базах, созданных до появления миграций,
+-- таблицы уже есть, и IF NOT EXISTS их не трогает.
+-- Первичные ключи cart, "order", payment, review и "user" получают
+-- последовательности в 0002_id_sequences.
+
+CREATE TABLE IF NOT EXISTS category (
+    id                     integer PRIMARY KEY,
+    название               varchar(100) NOT NULL,
+    описание               text,
+    родительская_категория integer REFERENCES category (id),
+    активна                boolean NOT NULL DEFAULT true
+);
+
+CREATE TABLE IF NOT EXISTS product (
+    id           integer PRIMARY KEY,
+    название     varchar(200) NOT NULL,
+    цена         numeric(10, 2) NOT NULL,
+    цвет         varchar(50),
+    размер       varchar(20),
+    изображение  varchar(255),
+    категория_id integer REFERENCES category (id),
+    активен      boolean NOT NULL DEFAULT true
+);
+
+CREATE TABLE IF NOT EXISTS "user" (
+    id               integer PRIMARY KEY,
+    email            varchar(255) NOT NULL,
+    пароль           varchar(255) NOT NULL,
+    имя              varchar(100) NOT NULL,
+    фамилия          varchar(100) NOT NULL,
+    телефон          varchar(20),
+    адрес            text,
+    дата_регистрации timestamp NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS cart (
+    id              integer PRIMARY KEY,
+    пользователь_id integer NOT NULL REFERENCES "user" (id),
+    товар_id        integer NOT NULL REFERENCES product (id),
+    количество      integer NOT NULL DEFAULT 1,
+    дата_добавления timestamp NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS "order" (
+    id              integer PRIMARY KEY,
+    пользователь_id integer NOT NULL REFERENCES "user" (id),
+    номер_заказа    varchar(50) NOT NULL,
+    статус          varchar(50) NOT NULL DEFAULT 'создан',
+    общая_сумма     numeric(12, 2) NOT NULL,
+    адрес_доставки  text,
+    дата_создания   timestamp NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS order_items (
+    id             serial PRIMARY KEY,
+    order_id       integer NOT NULL REFERENCES "order" (id),
+    product_id     integer REFERENCES product (id),
+    quantity       integer NOT NULL,
+    price_at_order numeric(10, 2) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS payment (
+    id            integer PRIMARY KEY,
+    заказ_id      integer NOT NULL REFERENCES "order" (id),
+    способ_оплаты varchar(50),
+    статус        varchar(50),
+    сумма         numeric(12, 2),
+    дата_оплаты   timestamp,
+    транзакция_id varchar(100)
+);
+
+CREATE TABLE IF NOT EXISTS review (
+    id              integer PRIMARY KEY,
+    пользователь_id integer NOT NULL REFERENCES "user" (id),
+    товар_id        integer NOT NULL REFERENCES product (id),
+    рейтинг         integer NOT NULL CHECK (рейтинг BETWEEN 1 AND 5),
+    комментарий     text,
+    дата_создания   timestamp NOT NULL DEFAULT now(),
+    одобрен         boolean NOT NULL DEFAULT false
+);
@@ -0,0 +1,7 @@
+ALTER TABLE cart ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE "order" ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE payment ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE review ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE "user" ALTER COLUMN id DROP DEFAULT;
+
+DROP SEQUENCE IF EXISTS cart_id_seq, order_id_seq, payment_id_seq, review_id_seq, user_id_seq;
@@ -0,0 +1,28 @@
+-- Генерация первичных ключей последовательностями вместо SELECT MAX(id) + 1.
+-- Миграция идемпотентна и подхватывает базы, где скрипт уже выполнялся вручную.
+--
+-- CACHE выделяет каждому соединению блок значений, поэтому при пуле
+-- соединений вставки почти не обращаются к общей последовательности.
+-- Пропуски в нумерации после перезапуска - нормальное поведение.
+
+LOCK TABLE cart, "order", payment, review, "user" IN EXCLUSIVE MODE;
+
+CREATE SEQUENCE IF NOT EXISTS cart_id_seq CACHE 20 OWNED BY cart.id;
+SELECT setval('cart_id_seq', COALESCE((SELECT MAX(id) FROM cart), 0) + 1, false);
+ALTER TABLE cart ALTER COLUMN id SET DEFAULT nextval('cart_id_seq');
+
+CREATE SEQUENCE IF NOT EXISTS order_id_seq CACHE 20 OWNED BY "order".id;
+SELECT setval('order_id_seq', COALESCE((SELECT MAX(id) FROM "order"), 0) + 1, false);
+ALTER TABLE "order" ALTER COLUMN id SET DEFAULT nextval('order_id_seq');
+
+CREATE SEQUENCE IF NOT EXISTS payment_id_seq CACHE 20 OWNED BY payment.id;
+SELECT setval('payment_id_seq', COALESCE((SELECT MAX(id) FROM payment), 0) + 1, false);
+ALTER TABLE payment ALTER COLUMN id SET DEFAULT nextval('payment_id_seq');
+
+CREATE SEQUENCE IF NOT EXISTS review_id_seq CACHE 20 OWNED BY review.id;
+SELECT setval('review_id_seq', COALESCE((SELECT MAX(id) FROM review), 0) + 1, false);
+ALTER TABLE review ALTER COLUMN id SET DEFAULT nextval('review_id_seq');
+
+CREATE SEQUENCE IF NOT EXISTS user_id_seq CACHE 20 OWNED BY "user".id;
+SELECT setval('user_id_seq', COALESCE((SELECT MAX(id) FROM "user"), 0) + 1, false);
+ALTER TABLE "user" ALTER COLUMN id SET DEFAULT nextval('user_id_seq');
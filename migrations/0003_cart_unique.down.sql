@@ -0,0 +1,3 @@
+-- Слитые дубликаты строк корзины не восстанавливаются.
+
+DROP INDEX IF EXISTS cart_user_product_uniq;
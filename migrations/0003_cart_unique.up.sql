@@ -0,0 +1,22 @@
+-- Уникальность строки корзины по (пользователь, товар) для INSERT ... ON CONFLICT
+-- в add_to_cart. Существующие дубликаты сливаются в одну строку с суммарным количеством.
+
+LOCK TABLE cart IN EXCLUSIVE MODE;
+
+UPDATE cart c
+SET количество = d.total
+FROM (
+    SELECT MIN(id) AS keep_id, SUM(количество) AS total
+    FROM cart
+    GROUP BY пользователь_id, товар_id
+    HAVING COUNT(*) > 1
+) d
+WHERE c.id = d.keep_id;
+
+DELETE FROM cart c
+USING cart k
+WHERE c.пользователь_id = k.пользователь_id
+  AND c.товар_id = k.товар_id
+  AND c.id > k.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS cart_user_product_uniq ON cart (пользователь_id, товар_id);
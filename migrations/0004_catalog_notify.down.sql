@@ -0,0 +1,4 @@
+DROP TRIGGER IF EXISTS product_catalog_changed ON product;
+DROP TRIGGER IF EXISTS category_catalog_changed ON category;
+DROP FUNCTION IF EXISTS notify_catalog_changed();
+DROP TABLE IF EXISTS catalog_version;
@@ -0,0 +1,30 @@
+-- Уведомление воркеров об изменении каталога: после любой записи в product
+-- или category увеличивается версия каталога и отправляется NOTIFY
+-- catalog_changed с именем таблицы, и каждый воркер сбрасывает свой кэш каталога.
+-- Версия и время изменения служат валидаторами ETag / Last-Modified.
+
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id         boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version    bigint NOT NULL DEFAULT 1,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+INSERT INTO catalog_version (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+BEGIN
+    UPDATE catalog_version SET version = version + 1, updated_at = now();
+    PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS product_catalog_changed ON product;
+CREATE TRIGGER product_catalog_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON product
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed();
+
+DROP TRIGGER IF EXISTS category_catalog_changed ON category;
+CREATE TRIGGER category_catalog_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON category
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed();
@@ -0,0 +1,8 @@
+-- migrate: no-transaction
+
+DROP INDEX CONCURRENTLY IF EXISTS product_active_category_id_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_active_category_price_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_active_category_name_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_active_id_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_active_price_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_active_name_idx;
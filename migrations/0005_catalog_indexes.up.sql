@@ -0,0 +1,20 @@
+-- Индексы для keyset-пагинации каталога: фильтр (активен, категория_id)
+-- и ключ сортировки с id в конце, чтобы порядок был однозначным.
+-- CONCURRENTLY не блокирует запись, поэтому миграция выполняется вне транзакции.
+-- migrate: no-transaction
+
+-- Товары одной категории
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_active_category_id_idx
+    ON product (активен, категория_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_active_category_price_idx
+    ON product (активен, категория_id, цена, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_active_category_name_idx
+    ON product (активен, категория_id, название, id);
+
+-- Все товары ("Вся одежда" и каталог без категории)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_active_id_idx
+    ON product (активен, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_active_price_idx
+    ON product (активен, цена, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_active_name_idx
+    ON product (активен, название, id);
@@ -0,0 +1,8 @@
+-- Расширение pg_trgm остается: им могут пользоваться другие объекты базы.
+
+DROP TRIGGER IF EXISTS product_search_refresh ON product;
+DROP TRIGGER IF EXISTS category_search_refresh ON category;
+DROP FUNCTION IF EXISTS product_search_on_product();
+DROP FUNCTION IF EXISTS product_search_on_category();
+DROP FUNCTION IF EXISTS refresh_product_search(integer[]);
+DROP TABLE IF EXISTS product_search;
@@ -0,0 +1,63 @@
+-- Поисковый индекс товаров: название, цвет, размер и название категории.
+-- document    - tsvector для полнотекстового поиска с ранжированием и префиксами
+-- search_text - тот же текст для нечеткого поиска по триграммам (опечатки)
+-- Таблица поддерживается триггерами на product и category.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE IF NOT EXISTS product_search (
+    product_id  integer PRIMARY KEY REFERENCES product (id) ON DELETE CASCADE,
+    document    tsvector NOT NULL,
+    search_text text NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS product_search_document_idx
+    ON product_search USING gin (document);
+CREATE INDEX IF NOT EXISTS product_search_text_trgm_idx
+    ON product_search USING gin (search_text gin_trgm_ops);
+
+-- Пересчет строк индекса для товаров (NULL - для всех)
+CREATE OR REPLACE FUNCTION refresh_product_search(product_ids integer[]) RETURNS void AS $$
+BEGIN
+    INSERT INTO product_search (product_id, document, search_text)
+    SELECT
+        p.id,
+        setweight(to_tsvector('russian', coalesce(p.название, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(c.название, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(p.цвет, '') || ' ' || coalesce(p.размер, '')), 'C'),
+        lower(concat_ws(' ', p.название, c.название, p.цвет, p.размер))
+    FROM product p
+    LEFT JOIN category c ON p.категория_id = c.id
+    WHERE product_ids IS NULL OR p.id = ANY(product_ids)
+    ON CONFLICT (product_id) DO UPDATE
+    SET document = EXCLUDED.document,
+        search_text = EXCLUDED.search_text;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION product_search_on_product() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_product_search(ARRAY[NEW.id]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION product_search_on_category() RETURNS trigger AS $$
+BEGIN
+    PERFORM refresh_product_search(ARRAY(SELECT id FROM product WHERE категория_id = NEW.id));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS product_search_refresh ON product;
+CREATE TRIGGER product_search_refresh
+    AFTER INSERT OR UPDATE OF название, цвет, размер, категория_id ON product
+    FOR EACH ROW EXECUTE FUNCTION product_search_on_product();
+
+DROP TRIGGER IF EXISTS category_search_refresh ON category;
+CREATE TRIGGER category_search_refresh
+    AFTER UPDATE OF название ON category
+    FOR EACH ROW EXECUTE FUNCTION product_search_on_category();
+
+-- Первичное заполнение
+SELECT refresh_product_search(NULL);
@@ -0,0 +1,2 @@
+DROP TRIGGER IF EXISTS review_published_changed ON review;
+DROP FUNCTION IF EXISTS notify_reviews_changed();
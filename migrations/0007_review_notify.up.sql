@@ -0,0 +1,18 @@
+-- Уведомление воркеров об изменении опубликованных отзывов: NOTIFY reviews_changed
+-- сбрасывает закэшированную главную страницу. Неодобренные отзывы на главной
+-- не показываются, поэтому их добавление уведомления не вызывает.
+
+CREATE OR REPLACE FUNCTION notify_reviews_changed() RETURNS trigger AS $$
+BEGIN
+    IF (TG_OP IN ('UPDATE', 'DELETE') AND OLD.одобрен)
+        OR (TG_OP IN ('INSERT', 'UPDATE') AND NEW.одобрен) THEN
+        PERFORM pg_notify('reviews_changed', TG_OP);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS review_published_changed ON review;
+CREATE TRIGGER review_published_changed
+    AFTER INSERT OR UPDATE OR DELETE ON review
+    FOR EACH ROW EXECUTE FUNCTION notify_reviews_changed();
@@ -0,0 +1,2 @@
+DROP FUNCTION IF EXISTS refresh_sales_stats();
+DROP TABLE IF EXISTS product_sales, sales_totals;
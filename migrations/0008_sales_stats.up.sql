@@ -0,0 +1,52 @@
+-- Агрегаты продаж для /admin/stats: продажи по товарам и общая статистика
+-- заказов. Приложение увеличивает их в транзакциях оформления и оплаты
+-- заказа, refresh_sales_stats() пересчитывает все с нуля (фоновая сверка).
+
+CREATE TABLE IF NOT EXISTS product_sales (
+    product_id   integer PRIMARY KEY,
+    units        bigint NOT NULL DEFAULT 0,
+    revenue      numeric(14, 2) NOT NULL DEFAULT 0,
+    orders_count bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS sales_totals (
+    id            boolean PRIMARY KEY DEFAULT true CHECK (id),
+    orders_count  bigint NOT NULL DEFAULT 0,
+    orders_total  numeric(14, 2) NOT NULL DEFAULT 0,
+    paid_count    bigint NOT NULL DEFAULT 0,
+    paid_total    numeric(14, 2) NOT NULL DEFAULT 0,
+    reconciled_at timestamptz
+);
+
+INSERT INTO sales_totals (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+-- Полный пересчет. Блокировка EXCLUSIVE ждет уже начатые транзакции заказов
+-- и не пускает новые до конца пересчета, поэтому ни одно увеличение
+-- не теряется и не учитывается дважды; чтение агрегатов не блокируется.
+CREATE OR REPLACE FUNCTION refresh_sales_stats() RETURNS void AS $$
+BEGIN
+    LOCK TABLE product_sales, sales_totals IN EXCLUSIVE MODE;
+
+    DELETE FROM product_sales;
+    INSERT INTO product_sales (product_id, units, revenue, orders_count)
+    SELECT product_id, SUM(quantity), SUM(quantity * price_at_order), COUNT(DISTINCT order_id)
+    FROM order_items
+    GROUP BY product_id;
+
+    UPDATE sales_totals t
+    SET orders_count = o.orders_count,
+        orders_total = o.orders_total,
+        paid_count = o.paid_count,
+        paid_total = o.paid_total,
+        reconciled_at = now()
+    FROM (
+        SELECT COUNT(*) AS orders_count,
+               COALESCE(SUM(общая_сумма), 0) AS orders_total,
+               COUNT(*) FILTER (WHERE статус = 'оплачен') AS paid_count,
+               COALESCE(SUM(общая_сумма) FILTER (WHERE статус = 'оплачен'), 0) AS paid_total
+        FROM "order"
+    ) o;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT refresh_sales_stats();
@@ -0,0 +1,4 @@
+DROP TRIGGER IF EXISTS order_table_changed ON "order";
+DROP TRIGGER IF EXISTS order_items_table_changed ON order_items;
+DROP TRIGGER IF EXISTS user_table_changed ON "user";
+DROP FUNCTION IF EXISTS notify_table_changed();
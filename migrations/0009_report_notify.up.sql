@@ -0,0 +1,26 @@
+-- Уведомление воркеров о записи в таблицы заказов и пользователей: NOTIFY
+-- table_changed с именем таблицы сбрасывает закэшированные SQL-отчеты
+-- (/execute_query/<id>), которые строятся по этой таблице. Изменения товаров,
+-- категорий и отзывов приходят через catalog_changed и reviews_changed.
+
+CREATE OR REPLACE FUNCTION notify_table_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('table_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS order_table_changed ON "order";
+CREATE TRIGGER order_table_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "order"
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_changed();
+
+DROP TRIGGER IF EXISTS order_items_table_changed ON order_items;
+CREATE TRIGGER order_items_table_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON order_items
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_changed();
+
+DROP TRIGGER IF EXISTS user_table_changed ON "user";
+CREATE TRIGGER user_table_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "user"
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_changed();
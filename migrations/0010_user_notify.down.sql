@@ -0,0 +1,2 @@
+DROP TRIGGER IF EXISTS user_profile_changed ON "user";
+DROP FUNCTION IF EXISTS notify_user_changed();
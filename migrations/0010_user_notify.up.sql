@@ -0,0 +1,17 @@
+-- Уведомление воркеров об изменении профиля пользователя: NOTIFY user_changed
+-- с id пользователя сбрасывает его запись в кэше профилей (имя, email, адрес).
+-- Смена пароля тоже вызывает уведомление.
+
+CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR OLD IS DISTINCT FROM NEW THEN
+        PERFORM pg_notify('user_changed', OLD.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_profile_changed ON "user";
+CREATE TRIGGER user_profile_changed
+    AFTER UPDATE OR DELETE ON "user"
+    FOR EACH ROW EXECUTE FUNCTION notify_user_changed();
@@ -0,0 +1,27 @@
+-- Сводка корзины пользователя: число строк, число товаров и сумма. Приложение
+-- меняет ее тем же запросом, что и корзину (добавление, удаление, изменение
+-- количества, оформление заказа), и копирует в сессию для значка корзины.
+-- Скрипт заполняет сводку по текущим корзинам, его можно запускать повторно.
+
+CREATE TABLE IF NOT EXISTS cart_summary (
+    пользователь_id integer PRIMARY KEY,
+    lines           integer NOT NULL DEFAULT 0,
+    items           integer NOT NULL DEFAULT 0,
+    subtotal        numeric(12, 2) NOT NULL DEFAULT 0,
+    updated_at      timestamptz NOT NULL DEFAULT now()
+);
+
+INSERT INTO cart_summary (пользователь_id, lines, items, subtotal)
+SELECT c.пользователь_id, COUNT(*), SUM(c.количество), SUM(c.количество * p.цена)
+FROM cart c
+JOIN product p ON p.id = c.товар_id
+GROUP BY c.пользователь_id
+ON CONFLICT (пользователь_id) DO UPDATE
+SET lines = EXCLUDED.lines,
+    items = EXCLUDED.items,
+    subtotal = EXCLUDED.subtotal,
+    updated_at = now();
+
+UPDATE cart_summary s
+SET lines = 0, items = 0, subtotal = 0, updated_at = now()
+WHERE NOT EXISTS (SELECT 1 FROM cart c WHERE c.пользователь_id = s.пользователь_id);
@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+
+DROP INDEX CONCURRENTLY IF EXISTS order_items_order_id_idx;
+DROP INDEX CONCURRENTLY IF EXISTS review_approved_created_idx;
+DROP INDEX CONCURRENTLY IF EXISTS payment_order_id_idx;
+DROP INDEX CONCURRENTLY IF EXISTS user_email_idx;
@@ -0,0 +1,16 @@
+-- Индексы для горячих запросов: строки заказа по order_id (мои заказы,
+-- страница заказа, отчеты), последние одобренные отзывы на главной, оплата
+-- заказа по заказ_id и вход по email. Корзину по (пользователь_id, товар_id)
+-- покрывает cart_user_product_uniq, товары по (активен, категория_id) -
+-- индексы каталога. migrate.REQUIRED_INDEXES проверяет их все при старте.
+-- CONCURRENTLY не блокирует запись, поэтому миграция выполняется вне транзакции.
+-- migrate: no-transaction
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS order_items_order_id_idx
+    ON order_items (order_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS review_approved_created_idx
+    ON review (одобрен, дата_создания);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS payment_order_id_idx
+    ON payment (заказ_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS user_email_idx
+    ON "user" (email);
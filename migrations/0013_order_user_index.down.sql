@@ -0,0 +1,3 @@
+-- migrate: no-transaction
+
+DROP INDEX CONCURRENTLY IF EXISTS order_user_created_idx;
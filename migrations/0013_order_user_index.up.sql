@@ -0,0 +1,7 @@
+-- Заказы пользователя по дате: страницы "Мои заказы" (курсор по
+-- (дата_создания, id)) и итоги по пользователю. Без индекса каждый запрос
+-- сканирует всю таблицу "order".
+-- migrate: no-transaction
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS order_user_created_idx
+    ON "order" (пользователь_id, дата_создания, id);
@@ -0,0 +1,31 @@
+-- Прежняя функция пересчета из 0008_sales_stats. Пересчет с нуля учитывает
+-- и заказы, которые пока есть только в sales_totals_delta.
+CREATE OR REPLACE FUNCTION refresh_sales_stats() RETURNS void AS $$
+BEGIN
+    LOCK TABLE product_sales, sales_totals IN EXCLUSIVE MODE;
+
+    DELETE FROM product_sales;
+    INSERT INTO product_sales (product_id, units, revenue, orders_count)
+    SELECT product_id, SUM(quantity), SUM(quantity * price_at_order), COUNT(DISTINCT order_id)
+    FROM order_items
+    GROUP BY product_id;
+
+    UPDATE sales_totals t
+    SET orders_count = o.orders_count,
+        orders_total = o.orders_total,
+        paid_count = o.paid_count,
+        paid_total = o.paid_total,
+        reconciled_at = now()
+    FROM (
+        SELECT COUNT(*) AS orders_count,
+               COALESCE(SUM(общая_сумма), 0) AS orders_total,
+               COUNT(*) FILTER (WHERE статус = 'оплачен') AS paid_count,
+               COALESCE(SUM(общая_сумма) FILTER (WHERE статус = 'оплачен'), 0) AS paid_total
+        FROM "order"
+    ) o;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT refresh_sales_stats();
+
+DROP TABLE IF EXISTS sales_totals_delta;
@@ -0,0 +1,44 @@
+-- Общая статистика заказов без единственной горячей строки: каждый заказ и
+-- каждая оплата добавляют свою строку в sales_totals_delta вместо UPDATE
+-- sales_totals, поэтому параллельные оформления не ждут друг друга.
+-- /admin/stats читает sales_totals плюс сумму дельт, refresh_sales_stats()
+-- пересчитывает итоги с нуля и удаляет накопившиеся дельты.
+
+CREATE TABLE IF NOT EXISTS sales_totals_delta (
+    id           bigserial PRIMARY KEY,
+    orders_count integer NOT NULL DEFAULT 0,
+    orders_total numeric(14, 2) NOT NULL DEFAULT 0,
+    paid_count   integer NOT NULL DEFAULT 0,
+    paid_total   numeric(14, 2) NOT NULL DEFAULT 0
+);
+
+-- Блокировка EXCLUSIVE по-прежнему ждет уже начатые транзакции заказов
+-- и оплат (они пишут в product_sales и sales_totals_delta), поэтому дельта
+-- либо уже учтена пересчетом и удаляется, либо появится после него.
+CREATE OR REPLACE FUNCTION refresh_sales_stats() RETURNS void AS $$
+BEGIN
+    LOCK TABLE product_sales, sales_totals, sales_totals_delta IN EXCLUSIVE MODE;
+
+    DELETE FROM product_sales;
+    INSERT INTO product_sales (product_id, units, revenue, orders_count)
+    SELECT product_id, SUM(quantity), SUM(quantity * price_at_order), COUNT(DISTINCT order_id)
+    FROM order_items
+    GROUP BY product_id;
+
+    UPDATE sales_totals t
+    SET orders_count = o.orders_count,
+        orders_total = o.orders_total,
+        paid_count = o.paid_count,
+        paid_total = o.paid_total,
+        reconciled_at = now()
+    FROM (
+        SELECT COUNT(*) AS orders_count,
+               COALESCE(SUM(общая_сумма), 0) AS orders_total,
+               COUNT(*) FILTER (WHERE статус = 'оплачен') AS paid_count,
+               COALESCE(SUM(общая_сумма) FILTER (WHERE статус = 'оплачен'), 0) AS paid_total
+        FROM "order"
+    ) o;
+
+    DELETE FROM sales_totals_delta;
+END;
+$$ LANGUAGE plpgsql;
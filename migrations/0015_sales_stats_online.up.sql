@@ -0,0 +1,82 @@
+-- Сверка агрегатов продаж без блокировки таблиц: прежняя refresh_sales_stats()
+-- держала EXCLUSIVE на product_sales и sales_totals_delta все время пересчета,
+-- и оформление и оплата заказов на это время останавливались.
+--
+-- Каждый шаг - одна команда, поэтому заказы, строки заказов, агрегаты и дельты
+-- в ней видны в одном снимке:
+-- * product_sales исправляется на разницу между снимком order_items и снимком
+--   самих агрегатов. Увеличения от заказов, которые снимок не видит, не
+--   затираются: ON CONFLICT DO UPDATE прибавляет разницу к последней версии строки.
+-- * sales_totals получает итоги по снимку "order", и в той же команде удаляются
+--   ровно те дельты, которые этот снимок видит (дельта пишется в одной
+--   транзакции со своим заказом или оплатой). Более поздние дельты остаются.
+-- Приложение вызывает функцию под advisory-блокировкой сверки, поэтому
+-- две сверки одновременно не выполняются.
+
+CREATE OR REPLACE FUNCTION refresh_sales_stats() RETURNS void AS $$
+BEGIN
+    INSERT INTO product_sales AS s (product_id, units, revenue, orders_count)
+    SELECT product_id,
+           COALESCE(a.units, 0) - COALESCE(p.units, 0),
+           COALESCE(a.revenue, 0) - COALESCE(p.revenue, 0),
+           COALESCE(a.orders_count, 0) - COALESCE(p.orders_count, 0)
+    FROM (
+        SELECT product_id, SUM(quantity) AS units, SUM(quantity * price_at_order) AS revenue,
+               COUNT(DISTINCT order_id) AS orders_count
+        FROM order_items
+        GROUP BY product_id
+    ) a
+    FULL JOIN product_sales p USING (product_id)
+    WHERE COALESCE(a.units, 0) <> COALESCE(p.units, 0)
+       OR COALESCE(a.revenue, 0) <> COALESCE(p.revenue, 0)
+       OR COALESCE(a.orders_count, 0) <> COALESCE(p.orders_count, 0)
+    -- В том же порядке, что и при оформлении заказа, чтобы не ловить deadlock
+    ORDER BY product_id
+    ON CONFLICT (product_id) DO UPDATE
+    SET units = s.units + EXCLUDED.units,
+        revenue = s.revenue + EXCLUDED.revenue,
+        orders_count = s.orders_count + EXCLUDED.orders_count;
+
+    -- DELETE в WITH выполняется целиком, даже если результат не читается
+    WITH folded AS (
+        DELETE FROM sales_totals_delta
+    )
+    UPDATE sales_totals t
+    SET orders_count = o.orders_count,
+        orders_total = o.orders_total,
+        paid_count = o.paid_count,
+        paid_total = o.paid_total,
+        reconciled_at = now()
+    FROM (
+        SELECT COUNT(*) AS orders_count,
+               COALESCE(SUM(общая_сумма), 0) AS orders_total,
+               COUNT(*) FILTER (WHERE статус = 'оплачен') AS paid_count,
+               COALESCE(SUM(общая_сумма) FILTER (WHERE статус = 'оплачен'), 0) AS paid_total
+        FROM "order"
+    ) o;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Перенос накопившихся дельт в sales_totals без пересчета: дешево, поэтому
+-- выполняется часто и не дает sales_totals_delta расти, даже если полная
+-- сверка отключена
+CREATE OR REPLACE FUNCTION fold_sales_totals() RETURNS void AS $$
+BEGIN
+    WITH folded AS (
+        DELETE FROM sales_totals_delta
+        RETURNING orders_count, orders_total, paid_count, paid_total
+    )
+    UPDATE sales_totals t
+    SET orders_count = t.orders_count + d.orders_count,
+        orders_total = t.orders_total + d.orders_total,
+        paid_count = t.paid_count + d.paid_count,
+        paid_total = t.paid_total + d.paid_total
+    FROM (
+        SELECT COALESCE(SUM(orders_count), 0) AS orders_count,
+               COALESCE(SUM(orders_total), 0) AS orders_total,
+               COALESCE(SUM(paid_count), 0) AS paid_count,
+               COALESCE(SUM(paid_total), 0) AS paid_total
+        FROM folded
+    ) d;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,87 @@
+"""Хэширование и проверка паролей в ограниченном пуле потоков.
+
+scrypt и pbkdf2 из werkzeug считаются в hashlib без GIL, поэтому отдельные
+потоки действительно работают параллельно, а размер пула ограничивает,
+сколько ядер процесса может занять вход и регистрация. Если все потоки
+заняты и очередь заполнена, запрос сразу получает отказ (Overloaded),
+а не ждет, занимая поток воркера.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Префиксы хэшей в колонке пароль; остальное - пароли в открытом виде,
+# которые переводит на хэши rehash_passwords.py
+HASH_PREFIXES = ('pbkdf2:', 'scrypt:', '$2b$')
+
+
+class Overloaded(Exception):
+    """Пул хэширования паролей перегружен"""
+
+
+class PasswordHasher:
+    """Пул на workers потоков с очередью не длиннее max_pending задач"""
+
+    def __init__(self, workers=2, max_pending=8, timeout=10.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._slots = None
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _check_pid(self):
+        # Потоки пула не переживают fork, в новом процессе создаем свой пул
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+            self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+            self._pid = os.getpid()
+
+    def _run(self, fn, *args):
+        self._check_pid()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            self.rejected += 1
+            raise Overloaded()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            raise Overloaded()
+        self.completed += 1
+        return result
+
+    def hash(self, password):
+        """generate_password_hash в пуле"""
+        return self._run(generate_password_hash, password)
+
+    def verify(self, pwhash, password):
+        """check_password_hash в пуле"""
+        return self._run(check_password_hash, pwhash, password)
+
+    def stats(self):
+        """Счетчики пула текущего процесса"""
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'pid': self._pid,
+        }
@@ -0,0 +1,49 @@
+"""Ограничение частоты запросов алгоритмом token bucket"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """Корзина токенов на каждый ключ (IP, email).
+
+    Корзина вмещает burst токенов и пополняется со скоростью rate токенов
+    в секунду, каждая попытка забирает один токен. Хранится не больше
+    maxsize ключей, дольше всего не использовавшиеся вытесняются.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (токенов, время обновления)
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def hit(self, key):
+        """Забираем токен: 0, если попытка разрешена, иначе сколько секунд ждать"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def stats(self):
+        """Счетчики ограничителя"""
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'keys': len(self._buckets),
+                'limited': self.limited,
+            }
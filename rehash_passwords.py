@@ -0,0 +1,123 @@
+"""Перевод оставшихся паролей в открытом виде на хэши (разовая миграция).
+
+    python rehash_passwords.py [--batch-size 1000] [--workers N] [--checkpoint файл] [--dry-run]
+
+Пользователи читаются серверным курсором по возрастанию id, хэши считаются
+пулом процессов на всех ядрах, результат пишется пачками UPDATE, после
+каждой пачки - commit и запись последнего id в файл контрольной точки.
+Прерванный запуск продолжается с контрольной точки. UPDATE меняет пароль,
+только если он не изменился с момента чтения, поэтому скрипт можно
+запускать на работающем сайте.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash
+
+from passwords import HASH_PREFIXES
+
+logger = logging.getLogger('rehash_passwords')
+
+DEFAULT_CHECKPOINT = 'rehash_passwords.checkpoint'
+
+
+def load_checkpoint(path):
+    """Последний обработанный id из файла контрольной точки"""
+    try:
+        with open(path) as f:
+            return json.load(f)['last_id']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def save_checkpoint(path, last_id, updated):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'last_id': last_id, 'updated': updated, 'saved_at': time.time()}, f)
+    os.replace(tmp_path, path)
+
+
+def write_batch(conn, rows, hashes):
+    """Пишем пачку хэшей одним UPDATE, пароли, измененные после чтения, не трогаем"""
+    cur = conn.cursor()
+    execute_values(cur, '''
+        UPDATE "user" u SET пароль = v.hash
+        FROM (VALUES %s) AS v(id, plain, hash)
+        WHERE u.id = v.id AND u.пароль = v.plain;
+    ''', [(user_id, plain, hashed) for (user_id, plain), hashed in zip(rows, hashes)],
+        template='(%s::integer, %s, %s)', page_size=len(rows))
+    updated = cur.rowcount
+    conn.commit()
+    cur.close()
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Хэширование паролей, хранящихся в открытом виде')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--dry-run', action='store_true', help='только посчитать, сколько паролей осталось')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    load_dotenv()
+    db_config = {
+        'host': os.getenv('DB_HOST'),
+        'database': os.getenv('DB_DATABASE'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD')
+    }
+    hash_patterns = [prefix + '%' for prefix in HASH_PREFIXES]
+    last_id = load_checkpoint(args.checkpoint)
+
+    # Чтение и запись в разных соединениях: commit закрыл бы серверный курсор
+    read_conn = psycopg2.connect(**db_config)
+    write_conn = psycopg2.connect(**db_config)
+
+    if args.dry_run:
+        cur = read_conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM "user" WHERE id > %s AND NOT (пароль LIKE ANY(%s));',
+                    (last_id, hash_patterns))
+        logger.info("Паролей в открытом виде после id %s: %d", last_id, cur.fetchone()[0])
+        return
+
+    logger.info("Начинаем с id > %s, процессов: %d, пачка: %d", last_id, args.workers, args.batch_size)
+    cur = read_conn.cursor(name='rehash_passwords')
+    cur.itersize = args.batch_size
+    cur.execute('''
+        SELECT id, пароль FROM "user"
+        WHERE id > %s AND NOT (пароль LIKE ANY(%s))
+        ORDER BY id;
+    ''', (last_id, hash_patterns))
+
+    total_read = total_updated = 0
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        while True:
+            rows = cur.fetchmany(args.batch_size)
+            if not rows:
+                break
+            chunksize = max(1, len(rows) // (args.workers * 4))
+            hashes = list(executor.map(generate_password_hash, [row[1] for row in rows], chunksize=chunksize))
+            total_updated += write_batch(write_conn, rows, hashes)
+            total_read += len(rows)
+            save_checkpoint(args.checkpoint, rows[-1][0], total_updated)
+            logger.info("Обработано %d, обновлено %d, последний id %s, %.0f паролей/с",
+                        total_read, total_updated, rows[-1][0], total_read / (time.monotonic() - started))
+
+    cur.close()
+    read_conn.close()
+    write_conn.close()
+    logger.info("Готово: прочитано %d, обновлено %d", total_read, total_updated)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Частые запросы приложения: подготовленные выражения и строки с именованными полями.
+
+Каждое выражение готовится (PREPARE) один раз на соединение пула при первом
+использовании и дальше выполняется по имени (EXECUTE), поэтому PostgreSQL
+не разбирает его заново на каждом HTTP-запросе, а после нескольких
+выполнений может взять готовый общий план. Строки результата - namedtuple:
+поля доступны по имени, а шаблоны и код, где еще остались индексы, работают
+как раньше.
+"""
+import threading
+import weakref
+from collections import namedtuple
+
+ProductDetail = namedtuple('ProductDetail', 'id name price color size image category')
+CartItem = namedtuple('CartItem', 'id product_id quantity added_at name price color category')
+Order = namedtuple('Order', 'id number status total address created_at transaction_id payment_method paid_at')
+Review = namedtuple('Review', 'comment rating created_at first_name last_name product')
+UserProfile = namedtuple('UserProfile', 'id email first_name last_name address')
+
+
+class Statement:
+    """Выражение: имя, типы параметров ($1, $2, ...), текст и тип строки результата"""
+
+    def __init__(self, name, param_types, row, sql):
+        self.name = name
+        self.row = row
+        self.sql = sql
+        self.prepare_sql = f'PREPARE {name} ({", ".join(param_types)}) AS {sql}'
+        self.execute_sql = f'EXECUTE {name} ({", ".join(["%s"] * len(param_types))});'
+
+
+STATEMENTS = {statement.name: statement for statement in (
+    # Карточка активного товара
+    Statement('product_detail', ('integer',), ProductDetail, '''
+        SELECT p.id, p.название, p.цена, p.цвет, p.размер, p.изображение, c.название
+        FROM product p
+        JOIN category c ON p.категория_id = c.id
+        WHERE p.id = $1 AND p.активен = True
+    '''),
+    # Корзина пользователя с товарами, новые строки первыми
+    Statement('cart_items', ('integer',), CartItem, '''
+        SELECT c.id, c.товар_id, c.количество, c.дата_добавления, p.название, p.цена, p.цвет, cat.название
+        FROM cart c
+        JOIN product p ON c.товар_id = p.id
+        JOIN category cat ON p.категория_id = cat.id
+        WHERE c.пользователь_id = $1
+        ORDER BY c.дата_добавления DESC
+    '''),
+    # Заказ пользователя с последней оплатой; чужой заказ не находится
+    Statement('user_order', ('integer', 'integer'), Order, '''
+        SELECT o.id, o.номер_заказа, o.статус, o.общая_сумма, o.адрес_доставки, o.дата_создания,
+               p.транзакция_id, p.способ_оплаты, p.дата_оплаты
+        FROM "order" o
+        LEFT JOIN LATERAL (
+            SELECT транзакция_id, способ_оплаты, дата_оплаты
+            FROM payment
+            WHERE заказ_id = o.id
+            ORDER BY id DESC
+            LIMIT 1
+        ) p ON true
+        WHERE o.id = $1 AND o.пользователь_id = $2
+    '''),
+    # Последние одобренные отзывы для главной страницы
+    Statement('approved_reviews', ('integer',), Review, '''
+        SELECT r.комментарий, r.рейтинг, r.дата_создания, u.имя, u.фамилия, p.название
+        FROM review r
+        JOIN "user" u ON r.пользователь_id = u.id
+        JOIN product p ON r.товар_id = p.id
+        WHERE r.одобрен = true
+        ORDER BY r.дата_создания DESC
+        LIMIT $1
+    '''),
+    # Профиль пользователя для шапки страниц и адреса доставки
+    Statement('user_profile', ('integer',), UserProfile, '''
+        SELECT id, email, имя, фамилия, адрес FROM "user" WHERE id = $1
+    '''),
+)}
+
+# Имена выражений, уже подготовленных на соединении. Подготовленное выражение
+# живет до закрытия соединения и не откатывается вместе с транзакцией
+_prepared = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _execute(conn, name, params):
+    statement = STATEMENTS[name]
+    with _lock:
+        prepared = _prepared.setdefault(conn, set())
+    cur = conn.cursor()
+    if name not in prepared:
+        cur.execute(statement.prepare_sql)
+        prepared.add(name)
+    cur.execute(statement.execute_sql, params)
+    return statement, cur
+
+
+def fetch_one(conn, name, *params):
+    """Первая строка результата выражения name или None"""
+    statement, cur = _execute(conn, name, params)
+    row = cur.fetchone()
+    cur.close()
+    return statement.row._make(row) if row else None
+
+
+def fetch_all(conn, name, *params):
+    """Все строки результата выражения name"""
+    statement, cur = _execute(conn, name, params)
+    rows = [statement.row._make(row) for row in cur.fetchall()]
+    cur.close()
+    return rows
+
+
+def statement_sql():
+    """Текст выражений по имени: трассировка показывает его для EXECUTE"""
+    return {name: statement.sql for name, statement in STATEMENTS.items()}
@@ -0,0 +1,117 @@
+"""Агрегаты продаж (миграция sales_stats): увеличение при заказе и оплате и фоновая сверка"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки: сверку в один момент выполняет только один воркер
+RECONCILE_LOCK_KEY = 7412001
+
+
+def record_order(cur, order_id, total):
+    """Учитываем новый заказ. Вызывается в транзакции оформления заказа до commit"""
+    # Строки товаров обновляются в порядке id, чтобы параллельные заказы не ловили deadlock
+    cur.execute('''
+        INSERT INTO product_sales AS s (product_id, units, revenue, orders_count)
+        SELECT product_id, SUM(quantity), SUM(quantity * price_at_order), 1
+        FROM order_items
+        WHERE order_id = %s
+        GROUP BY product_id
+        ORDER BY product_id
+        ON CONFLICT (product_id) DO UPDATE
+        SET units = s.units + EXCLUDED.units,
+            revenue = s.revenue + EXCLUDED.revenue,
+            orders_count = s.orders_count + 1;
+    ''', (order_id,))
+    # Общая статистика - отдельной строкой-дельтой (миграция sales_totals_delta):
+    # UPDATE единственной строки sales_totals выстраивал бы все оформления в очередь
+    cur.execute('''
+        INSERT INTO sales_totals_delta (orders_count, orders_total) VALUES (1, %s);
+    ''', (total,))
+
+
+def record_payment(cur, amount):
+    """Учитываем оплату заказа. Вызывается в транзакции оплаты до commit"""
+    cur.execute('''
+        INSERT INTO sales_totals_delta (paid_count, paid_total) VALUES (1, %s);
+    ''', (amount,))
+
+
+def _run_locked(conn, function):
+    """Вызываем функцию агрегатов, если сверкой или сверткой не занят другой воркер"""
+    cur = conn.cursor()
+    try:
+        # Сверка и свертка дельт не должны идти одновременно: свертка могла бы
+        # прибавить дельту, которую пересчет уже учел по своему снимку
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s);', (RECONCILE_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return False
+        cur.execute(f'SELECT {function}();')
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def reconcile(conn):
+    """Пересчитываем агрегаты с нуля и сворачиваем дельты, если этим не занят другой воркер"""
+    return _run_locked(conn, 'refresh_sales_stats')
+
+
+def fold(conn):
+    """Переносим дельты общей статистики в sales_totals без пересчета"""
+    return _run_locked(conn, 'fold_sales_totals')
+
+
+class SalesStatsRefresher:
+    """Фоновый поток, который раз в interval секунд сверяет агрегаты продаж,
+    а раз в fold_interval секунд сворачивает дельты общей статистики.
+
+    Сверку можно отключить (interval <= 0), свертку - нет: без нее
+    sales_totals_delta растет без ограничений. Запускается отдельно в каждом
+    процессе, одновременные сверки отсекаются advisory-блокировкой.
+    """
+
+    def __init__(self, pool, interval=600.0, fold_interval=60.0):
+        self.pool = pool
+        self.interval = interval
+        self.fold_interval = max(fold_interval, 1.0)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Запускаем поток, если в этом процессе он еще не запущен"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='sales-stats', daemon=True)
+            thread.start()
+
+    def _run(self):
+        next_reconcile = time.monotonic() + self.interval
+        while True:
+            time.sleep(self.fold_interval)
+            reconcile_now = self.interval > 0 and time.monotonic() >= next_reconcile
+            conn = None
+            try:
+                conn = self.pool.getconn()
+                if reconcile_now:
+                    next_reconcile = time.monotonic() + self.interval
+                    if reconcile(conn):
+                        logger.info("Агрегаты продаж пересчитаны")
+                else:
+                    fold(conn)
+            except Exception as e:
+                logger.warning("Не удалось обновить агрегаты продаж: %s", e)
+            finally:
+                if conn is not None:
+                    self.pool.putconn(conn)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Приложение импортируется без базы и без фоновых потоков
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('CATALOG_LISTEN', '0')
+os.environ.setdefault('SALES_STATS_REFRESH', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
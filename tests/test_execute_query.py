@@ -0,0 +1,120 @@
+"""Потоковая выгрузка отчетов /execute_query длиннее одной порции курсора"""
+import pytest
+
+import app as app_module
+
+
+class FakeCursor:
+    """Курсор без базы: именованный отдает rows, пока соединение не вернули в пул"""
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.closed = False
+        self.description = None
+        self.rowcount = -1
+        self.itersize = 2000
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        if self.name is not None:
+            self.description = [('id',), ('value',)]
+            self._rows = list(self.conn.rows)
+
+    def _check(self):
+        # В PostgreSQL откат транзакции закрывает серверный курсор
+        if self.closed or self.conn.returned:
+            raise RuntimeError('курсор закрыт')
+
+    def fetchmany(self, size):
+        self._check()
+        batch, self._rows = self._rows[:size], self._rows[size:]
+        return batch
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def __iter__(self):
+        while True:
+            batch = self.fetchmany(self.itersize)
+            if not batch:
+                return
+            self.conn.events.append('fetch')
+            yield from batch
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, rows, events):
+        self.rows = rows
+        self.events = events
+        self.returned = False
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, rows):
+        self.rows = rows
+        self.events = []
+        self.in_use = 0
+
+    def getconn(self):
+        self.in_use += 1
+        return FakeConnection(self.rows, self.events)
+
+    def putconn(self, conn):
+        if not conn.returned:
+            conn.returned = True
+            self.in_use -= 1
+            self.events.append('putconn')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, 'QUERY_STREAM_ITERSIZE', 3)
+    app_module.report_cache.invalidate()
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    return client
+
+
+@pytest.mark.parametrize('export_format', ['csv', 'ndjson', 'html'])
+def test_streams_all_rows_longer_than_itersize(client, monkeypatch, export_format):
+    rows = [(i, f'row-{i}') for i in range(10)]
+    pool = FakePool(rows)
+    monkeypatch.setattr(app_module, 'db_pool', pool)
+
+    response = client.get(f'/execute_query/1?format={export_format}')
+    body = response.get_data(as_text=True)
+    response.close()
+
+    assert response.status_code == 200
+    for _, value in rows:
+        assert value in body
+    # Соединение ответа возвращается в пул только после чтения курсора
+    assert pool.events[-2:] == ['fetch', 'putconn']
+    assert pool.in_use == 0
+
+
+def test_connection_returned_when_response_not_read(client, monkeypatch):
+    pool = FakePool([(i, f'row-{i}') for i in range(10)])
+    monkeypatch.setattr(app_module, 'db_pool', pool)
+
+    response = client.get('/execute_query/1?format=csv', buffered=False)
+    response.close()
+
+    assert pool.in_use == 0
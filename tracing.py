@@ -0,0 +1,164 @@
+"""Трассировка SQL: журнал медленных запросов, EXPLAIN и топ дорогих запросов"""
+import logging
+import re
+import threading
+import time
+
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_RE = re.compile(r'%(?:\(\w+\))?s')
+_SPACE_RE = re.compile(r'\s+')
+_READ_ONLY_RE = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_EXECUTE_RE = re.compile(r'^\s*EXECUTE\s+(\w+)', re.IGNORECASE)
+_WRITE_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|ALTER|DROP)\b', re.IGNORECASE)
+
+
+def query_text(cursor, query):
+    """Текст запроса строкой (запрос может быть bytes или psycopg2.sql.Composable)"""
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    if not isinstance(query, str):
+        return query.as_string(cursor)
+    return query
+
+
+def normalize(sql):
+    """Запрос без литералов и параметров, чтобы одинаковые запросы попадали в одну строку топа"""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _PLACEHOLDER_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    return _SPACE_RE.sub(' ', sql).strip().rstrip(';')
+
+
+class QueryTracer:
+    """Наблюдатель за запросами для db.query_observers.
+
+    Запросы дольше slow_ms пишутся в лог вместе с параметрами. При explain=True
+    для медленных SELECT выполняется EXPLAIN (ANALYZE, BUFFERS) - не чаще раза
+    в explain_interval секунд на нормализованный запрос. Статистика копится
+    по нормализованному тексту, хранится не более max_statements записей.
+
+    prepared - текст подготовленных выражений по имени: для EXECUTE имя
+    в лог и топ идет вместе с текстом выражения, по нему же решается,
+    можно ли выполнить EXPLAIN EXECUTE.
+    """
+
+    def __init__(self, slow_ms=200, explain=False, max_statements=500, explain_interval=300, prepared=None):
+        self.slow_seconds = slow_ms / 1000
+        self.explain = explain
+        self.max_statements = max_statements
+        self.explain_interval = explain_interval
+        self.prepared = prepared or {}
+        self._lock = threading.Lock()
+        self._statements = {}
+
+    def __call__(self, cursor, query, params, duration):
+        sql = query_text(cursor, query)
+        key = normalize(sql)
+        rowcount = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+
+        # Для EXECUTE смотрим на текст подготовленного выражения; неизвестное
+        # выражение считается пишущим
+        statement = None
+        checked_sql = sql
+        execute = _EXECUTE_RE.match(sql)
+        if execute:
+            statement = self.prepared.get(execute.group(1))
+            checked_sql = statement or ''
+            statement = normalize(statement) if statement else None
+
+        with self._lock:
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    # Вытесняем самый дешевый запрос, дорогие остаются в топе
+                    cheapest = min(self._statements, key=lambda k: self._statements[k]['total_time'])
+                    del self._statements[cheapest]
+                entry = self._statements[key] = {
+                    'query': key,
+                    'calls': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'rows': 0,
+                    'slow_calls': 0,
+                    'statement': statement,
+                    'plan': None,
+                    'explained_at': 0.0,
+                }
+            entry['calls'] += 1
+            entry['total_time'] += duration
+            entry['max_time'] = max(entry['max_time'], duration)
+            entry['rows'] += rowcount
+
+            if duration < self.slow_seconds:
+                return
+            entry['slow_calls'] += 1
+            need_plan = (self.explain and cursor.name is None
+                         and time.monotonic() - entry['explained_at'] >= self.explain_interval
+                         and _READ_ONLY_RE.match(checked_sql) and not _WRITE_RE.search(checked_sql))
+            if need_plan:
+                entry['explained_at'] = time.monotonic()
+
+        if statement:
+            logger.warning("Медленный запрос %.1f мс, строк %d: %s (%s); параметры: %.500r",
+                           duration * 1000, rowcount, key, statement, params)
+        else:
+            logger.warning("Медленный запрос %.1f мс, строк %d: %s; параметры: %.500r",
+                           duration * 1000, rowcount, key, params)
+
+        if need_plan:
+            plan = self._explain(cursor, query, params)
+            if plan:
+                with self._lock:
+                    entry['plan'] = plan
+                logger.info("План медленного запроса:\n%s", plan)
+
+    def _explain(self, cursor, query, params):
+        conn = cursor.connection
+        if conn.info.transaction_status == extensions.TRANSACTION_STATUS_INERROR:
+            return None
+        # Обычный курсор, а не InstrumentedCursor, чтобы EXPLAIN сам не попал в трассировку
+        explain_cursor = extensions.cursor(conn)
+        # Точка сохранения: ошибка EXPLAIN не должна ломать транзакцию запроса
+        use_savepoint = not conn.autocommit
+        try:
+            if use_savepoint:
+                explain_cursor.execute('SAVEPOINT query_trace_explain;')
+            explain_cursor.execute(b'EXPLAIN (ANALYZE, BUFFERS) ' + explain_cursor.mogrify(query, params))
+            plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+            if use_savepoint:
+                explain_cursor.execute('RELEASE SAVEPOINT query_trace_explain;')
+            return plan
+        except Exception as e:
+            logger.warning("Не удалось получить план запроса: %s", e)
+            if use_savepoint:
+                try:
+                    explain_cursor.execute('ROLLBACK TO SAVEPOINT query_trace_explain;')
+                except Exception:
+                    pass
+            return None
+        finally:
+            explain_cursor.close()
+
+    def top(self, limit=20):
+        """Самые дорогие запросы по суммарному времени"""
+        with self._lock:
+            entries = sorted(self._statements.values(), key=lambda e: e['total_time'], reverse=True)
+            return [
+                {
+                    'query': e['query'],
+                    'calls': e['calls'],
+                    'total_ms': round(e['total_time'] * 1000, 2),
+                    'mean_ms': round(e['total_time'] * 1000 / e['calls'], 2),
+                    'max_ms': round(e['max_time'] * 1000, 2),
+                    'rows': e['rows'],
+                    'slow_calls': e['slow_calls'],
+                    'statement': e['statement'],
+                    'plan': e['plan'],
+                }
+                for e in entries[:limit]
+            ]